@@ -0,0 +1,43 @@
+"""
+Time `import corv` and its submodules in fresh interpreters, as a short-lived
+worker or CLI invocation would see it.
+
+usage: python bench_import.py [nrepeat]
+"""
+
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+statements = ['pass',
+              'import numpy',
+              'import corv',
+              'import corv.spectral_resampling',
+              'import corv.utils',
+              'import corv.models',
+              'import corv.fit',
+              'import corv.sdss',
+              'import corv.sdss; corv.models.make_balmer_model()']
+
+def time_import(statement, nrepeat = 5):
+
+    times = []
+
+    for ii in range(nrepeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], check = True)
+        times.append(time.perf_counter() - t0)
+
+    return np.median(times), np.min(times)
+
+if __name__ == '__main__':
+
+    nrepeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    print('%-52s %10s %10s' % ('statement', 'median/ms', 'min/ms'))
+
+    for statement in statements:
+        median, best = time_import(statement, nrepeat)
+        print('%-52s %10.1f %10.1f' % (statement, 1e3 * median, 1e3 * best))
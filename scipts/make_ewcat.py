@@ -28,13 +28,11 @@ if __name__ == '__main__':
 		datapath = '/Users/vedantchandra/0_research/01_sdss5/006_build_corv/data/ddcands/' # abs. path with CATID folders
 		catpath = '/Users/vedantchandra/0_research/01_sdss5/006_build_corv/cat/' # abs. path with CATID folders
 
-	try:
-		starcat = Table.read(catpath + 'starcat.fits')
-		#expcat = Table.read(catpath + 'expcat.fits')
+	context = corv.sdss.DataContext(datapath, catpath)
+	corv.sdss.set_context(context)
+	context.index()
 
-		#print('starcat has %i stars' % len(starcat))
-	except:
-		pass#print('star and exposure catalogs not found! check paths and run make_catalogs() if you want to use sdss functionality. otherwise ignore.')
+	starcat = context.starcat
 
 
 	n_cpu = int(sys.argv[1])
@@ -12,4 +12,6 @@ setup(name='corv',
 	package_data={'corv':['models/*']},
 	dependency_links = [],
 	install_requires=['numpy', 'scipy', 'lmfit', 'matplotlib', 'astropy', 'tqdm'],
+	extras_require={'mcmc': ['emcee']},
+	entry_points={'console_scripts': ['corv-batch = corv.batch:main']},
 	include_package_data=True)
\ No newline at end of file
@@ -6,8 +6,18 @@ Created on Wed Aug 11 15:52:37 2021
 @author: vedantchandra
 """
 
-from . import models
-from . import utils
-from . import fit
-from . import spectral_resampling
-from . import sdss
+import importlib
+
+# Submodules are imported on first attribute access (PEP 562), so that 
+# `import corv` does not pay for lmfit, scipy, matplotlib or astropy until 
+# they are needed. `from corv import sdss` and `corv.sdss` work as before.
+
+__all__ = ['models', 'utils', 'fit', 'spectral_resampling', 'sdss', 'batch']
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,703 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch fitting of a DA catalog with corv, installed as the `corv-batch` command.
+
+Stars are fitted in chunks by a pool of worker processes, and each finished
+chunk is written to its own shard in <outdir>/shards/. An interrupted run
+restarted with the same outdir skips every star already in a shard. Once all
+chunks are done the shards are merged into <outdir>/corvcat.fits. Rows are
+streamed to disk as they are fitted, with a column schema fixed at the start
+of the run, so memory use does not grow with the size of the catalog.
+
+    corv-batch --catpath /path/to/cat/ --datapath /path/to/data/ --nproc 16
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+
+import numpy as np
+
+from . import fit, models, sdss, spectral_resampling, utils
+
+keepcol = ['AIRMASS', 'ALT', 'AZ', 'DATE-OBS', 'DEC', 'EXPTIME', 'G_DR2', 'HELIO_RV',
+           'IPA', 'MJD', 'PLATEID', 'QUALITY', 'RA', 'SDSSNAME', 'SRVYMODE', 'TAI-BEG',
+           'TAI-END', 'cid', 'expid', 'rfile', 'bfile']
+
+coadd_nan = ['coadd_teff', 'coadd_teff_err', 'coadd_logg', 'coadd_logg_err',
+             'coadd_rv_k', 'coadd_rv_err_k', 'coadd_rv_err_fisher_k', 'coadd_rv_redchi_k',
+             'coadd_rv_b', 'coadd_rv_err_b', 'coadd_rv_err_fisher_b', 'coadd_rv_redchi_b']
+
+exp_nan = ['rv_k', 'rv_err_k', 'rv_err_fisher_k', 'rv_redchi_k',
+           'rv_b', 'rv_err_b', 'rv_err_fisher_b', 'rv_redchi_b', 'exp_sn', 'exp_sn_est']
+
+# per-process state of the current run, set up by init_worker
+_state = {}
+
+def make_models():
+    """
+    Build the models fitted to every star.
+
+    Returns
+    -------
+    models : dict
+        kmodel7 (Koester, 7 lines) for the co-add, kmodel4 (Koester, 4 lines)
+        for exposures, and bmodel (Balmer Voigt profiles) for both.
+
+    """
+    return dict(kmodel7 = models.make_koester_model(names = ['n', 'z', 'e', 'd', 'g', 'b', 'a']),
+                kmodel4 = models.make_koester_model(names = ['d', 'g', 'b', 'a']),
+                bmodel = models.make_balmer_model(names = ['n', 'z', 'e', 'd', 'g', 'b', 'a']))
+
+def _savefig(path, *curves):
+    import matplotlib.pyplot as plt
+
+    plt.figure()
+    for x, y in curves:
+        plt.plot(x, y)
+    plt.savefig(path)
+    plt.close()
+
+def fit_star(cid, star_header, loaded, kmodel7, kmodel4, bmodel,
+             plotpath = None, cache = None, debug = False):
+    """
+    Fit the co-add of one star, then the RV of each of its exposures.
+
+    Parameters
+    ----------
+    cid : int
+        catalog ID.
+    star_header : dict
+        catalog row of the star, copied into every output row.
+    loaded : tuple
+        (exps, (wl, fl, ivar)) from sdss.load_star.
+    kmodel7, kmodel4, bmodel : LMFIT Model class
+        models from make_models.
+    plotpath : str, optional
+        if given, plots of the co-add, its fit and any failures are saved
+        here. The default is None.
+    cache : FitCache, optional
+        warm-start cache for the co-add and exposure fits. The default is None.
+    debug : bool, optional
+        re-raise fit errors other than ValueError. The default is False.
+
+    Returns
+    -------
+    rows : list
+        one dict per exposure, with the star's row, the exposure header
+        (keepcol) and the co-add and exposure fit results.
+
+    """
+    star_header = dict(star_header)
+    exps, (wl, fl, ivar) = loaded
+
+    coadd_sn, coadd_sn_est = utils.get_medsn(wl, fl, ivar)
+    star_header['coadd_sn'] = coadd_sn
+    star_header['coadd_sn_est'] = coadd_sn_est
+
+    if plotpath is not None:
+        _savefig(plotpath + '%i_coadd.jpg' % cid, (wl, fl))
+
+    coadd_res = coadd_res_b = None
+    cachekey = lambda name: None if cache is None else '%i_%s' % (cid, name)
+
+    try:
+        coadd_res = fit.fit_corv(wl, fl, ivar, kmodel7, iter_teff = True, compact = True,
+                                 cache = cache, key = cachekey('k'))[-1]
+        coadd_res_b = fit.fit_corv(wl, fl, ivar, bmodel, iter_teff = False, compact = True,
+                                   cache = cache, key = cachekey('b'))[-1]
+
+        star_header['coadd_teff'] = coadd_res.value('teff')
+        star_header['coadd_teff_err'] = coadd_res.error('teff')
+
+        star_header['coadd_logg'] = coadd_res.value('logg')
+        star_header['coadd_logg_err'] = coadd_res.error('logg')
+
+        star_header['coadd_rv_k'] = coadd_res.rv
+        star_header['coadd_rv_err_k'] = coadd_res.e_rv
+        star_header['coadd_rv_err_fisher_k'] = coadd_res.e_rv_fisher
+        star_header['coadd_rv_redchi_k'] = coadd_res.rv_redchi
+
+        star_header['coadd_rv_b'] = coadd_res_b.rv
+        star_header['coadd_rv_err_b'] = coadd_res_b.e_rv
+        star_header['coadd_rv_err_fisher_b'] = coadd_res_b.e_rv_fisher
+        star_header['coadd_rv_redchi_b'] = coadd_res_b.rv_redchi
+
+        if plotpath is not None:
+            import matplotlib.pyplot as plt
+            plt.figure()
+            utils.lineplot(wl, fl, ivar, kmodel7, coadd_res.to_params(kmodel7))
+            plt.savefig(plotpath + 'fit_%i.jpg' % cid)
+            plt.close()
+
+    except Exception as e:
+        print('coadd fit failed!')
+        print('the exception was %s' % e.__class__)
+        coadd_res = coadd_res_b = None
+        star_header.update({name: np.nan for name in coadd_nan})
+
+        if plotpath is not None:
+            _savefig(plotpath + '%i_coaddfailure_%s.jpg' % (cid, e.__class__.__name__), (wl, fl))
+
+        if debug and e.__class__.__name__ != 'ValueError':
+            raise
+
+    rows = []
+
+    for expnum, row in enumerate(exps['header']):
+        exp_header = {col: row[col] for col in keepcol if col in row.colnames}
+        data = exps['data'][expnum]
+
+        wl_i, fl_i, ivar_i = (10**np.asarray(data['logwl'], dtype = float),
+                              np.asarray(data['fl'], dtype = float),
+                              np.asarray(data['ivar'], dtype = float))
+
+        wlsel = (wl_i > 3750) & (wl_i < 8500)
+        wl_i, fl_i, ivar_i = wl_i[wlsel], fl_i[wlsel], ivar_i[wlsel]
+
+        exp_header.update({name: np.nan for name in exp_nan})
+
+        if coadd_res is not None:
+            expkey = lambda name: None if cache is None else '%i_%i_%s' % (cid, row['expid'], name)
+
+            try:
+                rv_k, e_rv_k, redchi_k, e_rv_fisher_k = fit.fit_rv(wl_i, fl_i, ivar_i, kmodel4,
+                                                                   coadd_res.to_params(kmodel4),
+                                                                   cache = cache, key = expkey('k'),
+                                                                   fisher = True)
+                rv_b, e_rv_b, redchi_b, e_rv_fisher_b = fit.fit_rv(wl_i, fl_i, ivar_i, bmodel,
+                                                                   coadd_res_b.to_params(bmodel),
+                                                                   cache = cache, key = expkey('b'),
+                                                                   fisher = True)
+
+                exp_header['rv_k'] = rv_k
+                exp_header['rv_err_k'] = e_rv_k
+                exp_header['rv_err_fisher_k'] = e_rv_fisher_k
+                exp_header['rv_redchi_k'] = redchi_k
+
+                exp_header['rv_b'] = rv_b
+                exp_header['rv_err_b'] = e_rv_b
+                exp_header['rv_err_fisher_b'] = e_rv_fisher_b
+                exp_header['rv_redchi_b'] = redchi_b
+
+                sn, sn_est = utils.get_medsn(wl_i, fl_i, ivar_i)
+                exp_header['exp_sn'] = sn
+                exp_header['exp_sn_est'] = sn_est
+
+            except Exception as e:
+                print('exposure fit failed for some reason!')
+                print('the exception was %s' % e.__class__)
+                exp_header.update({name: np.nan for name in exp_nan})
+
+                if plotpath is not None:
+                    _savefig(plotpath + '%i_coadd_expfailure.jpg' % cid, (wl, fl))
+                    _savefig(plotpath + '%i_expfailure_%i_%s.jpg' % (cid, expnum, e.__class__.__name__),
+                             (wl_i, fl_i))
+
+                if debug and e.__class__.__name__ != 'ValueError':
+                    raise
+
+        full_header = {**star_header, **exp_header}
+
+        # check and remove NONE (stderr returns None if cov mat fails)
+
+        for key, value in full_header.items():
+            if value is None:
+                full_header[key] = np.nan
+
+        rows.append(full_header)
+
+    return rows
+
+def _load_star(cid):
+    # load_star for prefetch, returning rather than raising errors so that
+    # one unreadable star does not end the chunk
+    try:
+        return sdss.load_star(cid)
+    except Exception as e:
+        return e
+
+def fit_chunk(cids):
+    """
+    Fit a chunk of stars with the current run's models and options, reading
+    the next stars' data on background threads while each one is fitted.
+    A star whose data cannot be read, or whose fit fails outside the
+    per-fit error handling of fit_star, is reported and skipped (or, with
+    debug, the error is re-raised), so the rest of the chunk is still
+    written.
+
+    Parameters
+    ----------
+    cids : array_like
+        catalog IDs, all of which must be in the run's catalog.
+
+    Yields
+    ------
+    rows : list
+        fit_star rows of each star in the chunk, as soon as it is fitted.
+
+    """
+    stars = _state['stars']
+
+    for cid, loaded in sdss.prefetch(_load_star, cids, nahead = _state['nahead']):
+        try:
+            if isinstance(loaded, Exception):
+                raise loaded
+            rows = fit_star(cid, stars[int(cid)], loaded, **_state['models'],
+                            plotpath = _state['plotpath'], cache = _state['cache'],
+                            debug = _state['debug'])
+        except Exception as e:
+            print('skipping star %i, the exception was %r' % (cid, e))
+            if _state['debug']:
+                raise
+            continue
+
+        yield rows
+
+def make_schema(dacat, expcat):
+    """
+    Columns of the output catalog, fixed before any star is fitted: the
+    columns of the input catalog, the co-add fit results, the exposure
+    header columns (keepcol) and the exposure fit results, in that order.
+
+    Parameters
+    ----------
+    dacat : Table
+        catalog of stars to fit.
+    expcat : Table
+        exposure catalog, for the types of the keepcol columns.
+
+    Returns
+    -------
+    schema : list
+        (name, dtype) of every column.
+
+    Raises
+    ------
+    ValueError
+        if a column has a dtype that cannot be written to a FITS table.
+
+    """
+    schema = [(name, dacat[name].dtype) for name in dacat.colnames]
+    schema += [(name, np.dtype(float)) for name in ['coadd_sn', 'coadd_sn_est'] + coadd_nan]
+    schema += [(name, expcat[name].dtype) for name in keepcol if name in expcat.colnames]
+    schema += [(name, np.dtype(float)) for name in exp_nan]
+
+    names = {}
+    for name, dtype in schema:
+        names.setdefault(name, dtype)
+
+    schema = list(names.items())
+    FitsTableWriter.check_schema(schema)
+
+    return schema
+
+class FitsTableWriter:
+    """
+    Append rows to a FITS binary table as they arrive, without holding the
+    table in memory. The schema is fixed when the writer is made: values of
+    None, masked values or missing keys are written as NaN in float columns,
+    99 in integer columns, False or '' otherwise. Integer types FITS cannot
+    hold (i1, u2, u4) are widened; u8 columns are rejected. The header is written first with
+    NAXIS2 = 0, and on close NAXIS2 is patched and the data padded to a
+    whole FITS block. The file is written to a temporary name and renamed
+    into place on close, so a partial table is never left at `path`.
+
+    """
+    block = 2880
+
+    # FITS has no signed byte or unsigned 16/32-bit integer columns
+    widen = dict(i1 = 'i2', u2 = 'i4', u4 = 'i8', f2 = 'f4')
+
+    def __init__(self, path, schema):
+        from astropy.io import fits
+
+        self.path = path
+        self.schema = [(name, np.dtype(dtype)) for name, dtype in schema]
+        self.check_schema(self.schema)
+        self.dtype = np.dtype([(name, self._file_dtype(dtype)) for name, dtype in self.schema])
+        self.nrows = 0
+
+        header = fits.Header([('XTENSION', 'BINTABLE'), ('BITPIX', 8), ('NAXIS', 2),
+                              ('NAXIS1', self.dtype.itemsize), ('NAXIS2', 0),
+                              ('PCOUNT', 0), ('GCOUNT', 1), ('TFIELDS', len(self.schema))])
+        for ii, (name, dtype) in enumerate(self.schema):
+            header['TTYPE%i' % (ii + 1)] = name
+            header['TFORM%i' % (ii + 1)] = self._tform(dtype)
+
+        primary = fits.Header([('SIMPLE', True), ('BITPIX', 8), ('NAXIS', 0), ('EXTEND', True)])
+        primary = primary.tostring().encode('ascii')
+
+        self._naxis2 = len(primary) + 80 * header.index('NAXIS2')
+
+        self._file = open(self.path + '.tmp', 'wb')
+        self._file.write(primary + header.tostring().encode('ascii'))
+
+    @classmethod
+    def check_schema(cls, schema):
+        """
+        Raise ValueError if a column's dtype cannot be written to FITS.
+
+        """
+        for name, dtype in schema:
+            dtype = np.dtype(dtype)
+            if dtype.kind not in 'USb' and cls._file_dtype(dtype).str[1:] not in cls.tforms:
+                raise ValueError('column %s has dtype %s, which cannot be written to '
+                                 'a FITS table' % (name, dtype))
+
+    tforms = dict(f8 = 'D', f4 = 'E', i8 = 'K', i4 = 'J', i2 = 'I', u1 = 'B')
+
+    @classmethod
+    def _file_dtype(cls, dtype):
+        if dtype.kind == 'U':
+            return np.dtype('S%i' % max(dtype.itemsize // 4, 1))
+        if dtype.kind == 'S':
+            return np.dtype('S%i' % max(dtype.itemsize, 1))
+        if dtype.kind == 'b':
+            return np.dtype('S1')
+        return np.dtype(cls.widen.get(dtype.str[1:], dtype)).newbyteorder('>')
+
+    def _tform(self, dtype):
+        if dtype.kind == 'b':
+            return 'L'
+        if dtype.kind in 'US':
+            return '%iA' % self._file_dtype(dtype).itemsize
+        return self.tforms[self._file_dtype(dtype).str[1:]]
+
+    @staticmethod
+    def _missing(value):
+        return value is None or (np.ma.isMaskedArray(value) and np.all(np.ma.getmaskarray(value)))
+
+    @staticmethod
+    def _fill(dtype):
+        if dtype.kind == 'f':
+            return np.nan
+        if dtype.kind in 'iu':
+            return 99
+        if dtype.kind == 'b':
+            return False
+        return ''
+
+    def write_columns(self, columns, nrows = None):
+        """
+        Append a columnar batch: a dict of equal-length arrays (or lists)
+        by column name. Columns not in the schema are ignored.
+
+        """
+        if nrows is None:
+            nrows = len(next(iter(columns.values()))) if len(columns) > 0 else 0
+
+        data = np.zeros(nrows, dtype = self.dtype)
+
+        for name, dtype in self.schema:
+            fill = self._fill(dtype)
+            values = columns.get(name)
+
+            if values is None:
+                values = [fill] * nrows
+            elif isinstance(values, list):
+                values = [fill if self._missing(value) else 
+                          value.filled(fill) if np.ma.isMaskedArray(value) else value 
+                          for value in values]
+            elif np.ma.isMaskedArray(values):
+                values = values.filled(fill)
+
+            values = np.asarray(values)
+
+            if dtype.kind == 'b':
+                values = np.where(values.astype(bool), b'T', b'F')
+            elif values.dtype.kind == 'U':
+                values = np.char.encode(values, 'ascii')
+
+            data[name] = values
+
+        self._file.write(data.tobytes())
+        self.nrows += nrows
+
+    def write(self, rows):
+        """
+        Append rows given as a list of dicts, e.g. from fit_star.
+
+        """
+        names = [name for name, _ in self.schema]
+        self.write_columns({name: [row.get(name) for row in rows] for name in names},
+                           nrows = len(rows))
+
+    def close(self):
+        from astropy.io import fits
+
+        size = self.nrows * self.dtype.itemsize
+        self._file.write(b'\0' * (-size % self.block))
+
+        self._file.seek(self._naxis2)
+        self._file.write(fits.Card('NAXIS2', self.nrows).image.encode('ascii'))
+        self._file.close()
+
+        os.replace(self.path + '.tmp', self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.path + '.tmp')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def _shard(shard_dir, index, ext):
+    return os.path.join(shard_dir, 'chunk_%06i.%s' % (index, ext))
+
+def _mark_done(shard_dir, index, cids):
+    path = _shard(shard_dir, index, 'cids.npy')
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, np.asarray(cids, dtype = int))
+    os.replace(path + '.tmp', path)
+
+def completed_shards(shard_dir):
+    """
+    Indices and cids of every completed shard in shard_dir.
+
+    Returns
+    -------
+    indices : list
+        chunk indices, in order.
+    cids : ndarray
+        every catalog ID in those chunks.
+
+    """
+    files = sorted(glob.glob(os.path.join(shard_dir, 'chunk_*.cids.npy')))
+    indices = [int(os.path.basename(file).split('_')[1].split('.')[0]) for file in files]
+    cids = [np.load(file) for file in files]
+
+    return indices, np.concatenate(cids) if len(cids) > 0 else np.zeros(0, dtype = int)
+
+def merge_shards(shard_dir, outfile, schema, block_size = 10000):
+    """
+    Stream every completed shard in shard_dir into one catalog at outfile,
+    block_size rows at a time.
+
+    Returns
+    -------
+    nrows : int
+        number of rows in the merged catalog.
+
+    """
+    from astropy.io import fits
+
+    indices, _ = completed_shards(shard_dir)
+    names = [name for name, _ in schema]
+
+    with FitsTableWriter(outfile, schema) as writer:
+        for index in indices:
+            with fits.open(_shard(shard_dir, index, 'fits'), memmap = True) as hdul:
+                data = hdul[1].data
+
+                if data is None:
+                    continue
+                if list(data.names) != names:
+                    raise ValueError('%s does not match the schema of this run'
+                                     % _shard(shard_dir, index, 'fits'))
+
+                for start in range(0, len(data), block_size):
+                    writer.write_columns({name: data[name][start:start + block_size]
+                                          for name in names})
+
+    return writer.nrows
+
+def init_worker(setup):
+    """
+    Set up a worker process once, as the Pool initializer: open the data
+    context and build its cid index, load the Koester grid, build the models,
+    point resampling operators at their on-disk cache, and read the catalog
+    of stars. Only `setup`, a small dict of paths and options, is sent to
+    the worker, and tasks carry only cids, so the pool behaves the same
+    under the fork, spawn and forkserver start methods.
+
+    Parameters
+    ----------
+    setup : dict
+        catalog, datapath, catpath, specstore, shard_dir, schema, cache,
+        operator_cache, nahead, plotpath and debug, as made by run().
+
+    """
+    from astropy.table import Table
+
+    context = sdss.DataContext(setup['datapath'], setup['catpath'], store = setup['specstore'])
+    sdss.set_context(context)
+    context.index()
+
+    if setup['operator_cache'] is not None:
+        spectral_resampling.cache_dir = setup['operator_cache']
+
+    try:
+        models.load_wd_interp()
+    except OSError:
+        pass # Koester fits then fail per star, and are NaN-filled
+
+    dacat = Table.read(setup['catalog'])
+
+    _state.clear()
+    _state.update(setup)
+    _state.update(stars = {int(row['cid']): dict(row) for row in dacat},
+                  models = make_models(),
+                  cache = None if setup['cache'] is None else fit.FitCache(setup['cache']))
+
+def _run_chunk(task):
+    index, cids = task
+    shard_dir = _state['shard_dir']
+
+    with FitsTableWriter(_shard(shard_dir, index, 'fits'), _state['schema']) as writer:
+        for rows in fit_chunk(cids):
+            writer.write(rows)
+
+    _mark_done(shard_dir, index, cids)
+
+    return len(cids)
+
+def run(catalog, outdir, datapath = sdss.datapath, catpath = sdss.catpath,
+        nproc = 1, nstar = 0, chunk_size = 20, nahead = 4, plotpath = None,
+        cache = None, operator_cache = None, specstore = None, debug = False,
+        merge = True, start_method = None):
+    """
+    Fit every star of `catalog` that is not already in a shard in outdir,
+    then merge the shards into <outdir>/corvcat.fits.
+
+    Parameters
+    ----------
+    catalog : str
+        FITS catalog of stars to fit, with a 'cid' column (e.g. dacat.fits).
+    outdir : str
+        output directory; shards go in <outdir>/shards/.
+    datapath, catpath : str, optional
+        paths of the data release, for sdss.DataContext.
+    nproc : int, optional
+        number of worker processes. The default is 1.
+    nstar : int, optional
+        if > 0, only fit the first nstar stars of the catalog. The default is 0.
+    chunk_size : int, optional
+        stars per chunk (and per shard). The default is 20.
+    nahead : int, optional
+        stars each worker reads ahead of the one it is fitting. The default is 4.
+    plotpath : str, optional
+        directory for diagnostic plots. The default is None (no plots).
+    cache : str, optional
+        directory of a FitCache used to warm-start fits. The default is None.
+    operator_cache : str, optional
+        directory where workers share resampling operators
+        (spectral_resampling.cache_dir). The default is None.
+    specstore : str or bool, optional
+        SpecStore directory to read exposures from, or False to read only
+        FITS files. The default is None, which uses <catpath>/specstore/
+        if it has been built.
+    debug : bool, optional
+        re-raise fit errors. The default is False.
+    merge : bool, optional
+        merge the shards once all chunks are done. The default is True.
+    start_method : str, optional
+        'fork', 'spawn' or 'forkserver'. The default is None, the platform
+        default.
+
+    Returns
+    -------
+    nrows : int or None
+        number of rows in corvcat.fits, if merge.
+
+    """
+    from astropy.table import Table
+    from tqdm import tqdm
+
+    context = sdss.DataContext(datapath, catpath)
+
+    dacat = Table.read(catalog)
+
+    if nstar > 0:
+        dacat = dacat[:nstar]
+        print('entering test mode, only fitting %i stars' % nstar)
+
+    shard_dir = os.path.join(outdir, 'shards')
+    os.makedirs(shard_dir, exist_ok = True)
+
+    indices, done = completed_shards(shard_dir)
+    cids = np.asarray(dacat['cid'])
+    todo = cids[~np.isin(cids, done)]
+
+    print('%i of %i stars already done, fitting %i' % (len(cids) - len(todo), len(cids), len(todo)))
+
+    start = max(indices) + 1 if len(indices) > 0 else 0
+    chunks = [todo[ii:ii + chunk_size] for ii in range(0, len(todo), chunk_size)]
+
+    setup = dict(catalog = catalog, datapath = datapath, catpath = catpath,
+                 specstore = specstore, shard_dir = shard_dir, schema = make_schema(dacat, context.expcat),
+                 cache = cache, operator_cache = operator_cache, nahead = nahead,
+                 plotpath = plotpath, debug = debug)
+
+    if len(chunks) > 0:
+        pool = multiprocessing.get_context(start_method).Pool(nproc, initializer = init_worker,
+                                                              initargs = (setup,))
+        with pool:
+            for _ in tqdm(pool.imap_unordered(_run_chunk, enumerate(chunks, start)),
+                          total = len(chunks)):
+                pass
+
+    if merge:
+        nrows = merge_shards(shard_dir, os.path.join(outdir, 'corvcat.fits'), setup['schema'])
+        print('wrote %i rows to %s' % (nrows, os.path.join(outdir, 'corvcat.fits')))
+        return nrows
+
+def main(argv = None):
+    """
+    Entry point of `corv-batch`; see `corv-batch --help`.
+
+    """
+    parser = argparse.ArgumentParser(prog = 'corv-batch',
+                                     description = 'Fit RVs of a DA catalog with corv, '
+                                     'in restartable chunks.')
+    parser.add_argument('--catpath', default = sdss.catpath,
+                        help = 'catalog directory (with expcat.fits)')
+    parser.add_argument('--datapath', default = sdss.datapath, help = 'data directory')
+    parser.add_argument('--catalog', default = None,
+                        help = 'stars to fit (default: CATPATH/dacat.fits)')
+    parser.add_argument('--outdir', default = None,
+                        help = 'output directory for shards and corvcat.fits (default: CATPATH)')
+    parser.add_argument('--nproc', type = int, default = 1, help = 'worker processes')
+    parser.add_argument('--nstar', type = int, default = 0,
+                        help = 'only fit the first NSTAR stars (test mode)')
+    parser.add_argument('--chunk-size', type = int, default = 20, help = 'stars per chunk')
+    parser.add_argument('--nahead', type = int, default = 4,
+                        help = 'stars each worker reads ahead')
+    parser.add_argument('--plotpath', default = None, help = 'save diagnostic plots here')
+    parser.add_argument('--cache', default = None, help = 'FitCache directory for warm starts')
+    parser.add_argument('--operator-cache', default = None,
+                        help = 'directory for resampling operators shared by workers')
+    parser.add_argument('--specstore', default = None,
+                        help = 'SpecStore directory (default: CATPATH/specstore/ if it exists)')
+    parser.add_argument('--no-specstore', action = 'store_true',
+                        help = 'read exposures from FITS files only')
+    parser.add_argument('--start-method', default = None, choices = ['fork', 'spawn', 'forkserver'],
+                        help = 'multiprocessing start method (default: platform default)')
+    parser.add_argument('--no-merge', action = 'store_true',
+                        help = 'only write shards, do not merge them')
+    parser.add_argument('--debug', action = 'store_true', help = 're-raise fit errors')
+
+    args = parser.parse_args(argv)
+
+    catalog = args.catalog if args.catalog is not None else args.catpath + 'dacat.fits'
+    outdir = args.outdir if args.outdir is not None else args.catpath
+
+    print('there are %i CPU cores' % args.nproc)
+
+    run(catalog, outdir, datapath = args.datapath, catpath = args.catpath,
+        nproc = args.nproc, nstar = args.nstar, chunk_size = args.chunk_size,
+        nahead = args.nahead, plotpath = args.plotpath, cache = args.cache,
+        operator_cache = args.operator_cache,
+        specstore = False if args.no_specstore else args.specstore, debug = args.debug,
+        merge = not args.no_merge, start_method = args.start_method)
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,8 @@ Created on Mon Aug 16 09:06:32 2021
 @author: vedantchandra
 """
 
-import lmfit
-import matplotlib.pyplot as plt
 import numpy as np
+import os
 
 from . import utils
 from . import models
@@ -29,6 +28,9 @@ def normalized_residual(wl, fl, ivar, corvmodel, params, fit_window = None):
         LMFIT model with normalization instructions.
     params : LMFIT Parameters class
         parameters at which to evaluate corvmodel.
+    fit_window : float, optional
+        if given, only pixels within this many Angstroms of a line centre
+        contribute. The default is None.
 
     Returns
     -------
@@ -37,36 +39,17 @@ def normalized_residual(wl, fl, ivar, corvmodel, params, fit_window = None):
 
     """
     
-    nwl, nfl, nivar = utils.cont_norm_lines(wl, fl, ivar,
-                                            corvmodel.names,
-                                            corvmodel.centres,
-                                            corvmodel.windows,
-                                            corvmodel.edges)
-        
-    if fit_window is not None:
-        for ii in range(len(nivar)):
-            in_center = []
-                        
-            for key in corvmodel.centres:
-                center = corvmodel.centres[key]
-                
-                if (center - fit_window < wl[ii] < center + fit_window):
-                    in_center.append(True)
-                else:
-                    in_center.append(False)
-                    
-            if not True in in_center:
-                nivar[ii] = 0            
+    data = prepare_data(wl, fl, ivar, corvmodel, fit_window = fit_window)
     
     _,nmodel = models.get_normalized_model(wl, corvmodel, params)
-    resid = (nfl - nmodel) * np.sqrt(nivar)
+    resid = (data['fl'] - nmodel) * np.sqrt(data['ivar'])
     
     return resid
 
 def xcorr_rv(wl, fl, ivar, corvmodel, params,
              min_rv = -1500, max_rv = 1500, 
              npoints = 500,
-             quad_window = 300, plot = False):
+             quad_window = 300, plot = False, fisher = False):
     """
     Find best RV via x-correlation on grid and quadratic fitting the peak.
 
@@ -91,33 +74,34 @@ def xcorr_rv(wl, fl, ivar, corvmodel, params,
     quad_window : float, optional
         window around minimum to fit quadratic model, 
         in km/s. The default is 300.
+    fisher : bool, optional
+        whether to also return the Fisher-information RV error from the 
+        template (see fisher_rv_error). The default is False.
 
     Returns
     -------
     rv : float
         best-fit radial velocity.
+    e_rv : float
+        RV error from the width of the chi-square parabola.
+    redchi : float
+        reduced chi-square at the best RV.
     rvgrid : array_like
         grid of radial velocities.
     cc : array_like
         chi-square statistic evaluated at each RV.
+    e_rv_fisher : float
+        Fisher-information RV error. Only returned if fisher is True.
 
     """
         
-    rvgrid = np.linspace(min_rv, max_rv, npoints)
-    cc = np.zeros(len(rvgrid))
-    rcc = np.zeros(len(rvgrid))
-    #params = corvmodel.make_params()
+    rvgrid, data, template = _xcorr_template(wl, fl, ivar, corvmodel, params,
+                                             min_rv, max_rv, npoints)
     
-    residual = lambda params: normalized_residual(wl, fl, ivar, 
-                                                  corvmodel, params, fit_window = 25)
-    #print(params)
-    for ii,rv in enumerate(rvgrid):
-        params['RV'].set(value = rv)
-        resid = residual(params)
-        chi = np.nansum(resid**2)
-        redchi = np.nansum(resid**2) / (len(resid) - 1)
-        cc[ii] = chi
-        rcc[ii] = redchi
+    cc = np.nansum((data['fl'] - template)**2 * data['ivar'], axis = 1)
+    rcc = cc / (template.shape[1] - 1)
+    
+    full_rvgrid = rvgrid
         
     window = int(quad_window / np.diff(rvgrid)[0])
 
@@ -153,6 +137,7 @@ def xcorr_rv(wl, fl, ivar, corvmodel, params,
         redchi = np.interp(rv, rvgrid, rcc)
     
         if plot:
+            import matplotlib.pyplot as plt
             xgrid = np.linspace(min(rvgrid), max(rvgrid), 50)
             
             f = plt.figure(figsize = (10,5))
@@ -166,11 +151,16 @@ def xcorr_rv(wl, fl, ivar, corvmodel, params,
             plt.axhline(y = t_cc, label = 'Minimum $\chi^2$')
             plt.legend()
             
+        if fisher:
+            e_rv_fisher = fisher_rv_error(full_rvgrid, template, data['ivar'], rv)
+            return rv, e_rv, redchi, rvgrid, cc, e_rv_fisher
+        
         return rv, e_rv, redchi, rvgrid, cc
     except:
         print('pcoef failed!! returning min of chi function & err = 999')
         rv = rvgrid[np.nanargmin(cc)]
         e_rv = 999
+        redchi = rcc[np.nanargmin(cc)]
         
     
     #print(t_cc)
@@ -179,11 +169,163 @@ def xcorr_rv(wl, fl, ivar, corvmodel, params,
     #
     #e_rv = (np.abs(min(rvgrid[temp]) -max(rvgrid[temp])) / 2)
     
+    if fisher:
+        e_rv_fisher = fisher_rv_error(full_rvgrid, template, data['ivar'], rv)
+        return rv, e_rv, redchi, rvgrid, cc, e_rv_fisher
         
     return rv, e_rv, redchi, rvgrid, cc
 
+def fisher_rv_error(rvgrid, template, ivar, rv):
+    """
+    Analytic RV precision from the Fisher information of the template. 
+    
+    sigma_RV = (sum ivar * (dmodel/dRV)^2)^(-1/2). The derivative is the 
+    central difference of the template at the grid nodes either side of rv, 
+    linearly interpolated to rv, so its accuracy is set by the grid step 
+    (6 km/s for the default xcorr_rv grid). This is O(N_pix) given the 
+    x-correlation template.
+
+    Parameters
+    ----------
+    rvgrid : array_like
+        RV grid of the template, in km/s.
+    template : array_like
+        normalized model at every grid RV, shape (len(rvgrid), n_pix).
+    ivar : array_like
+        normalized inverse-variance of the data, masked as in the fit.
+    rv : float
+        RV at which to evaluate the derivative.
+
+    Returns
+    -------
+    e_rv : float
+        RV uncertainty in km/s.
+
+    """
+    
+    jj = int(np.clip(np.searchsorted(rvgrid, rv) - 1, 1, len(rvgrid) - 3))
+    
+    central = lambda kk: (template[kk + 1] - template[kk - 1]) / (rvgrid[kk + 1] - rvgrid[kk - 1])
+    frac = np.clip((rv - rvgrid[jj]) / (rvgrid[jj + 1] - rvgrid[jj]), 0, 1)
+    dmdrv = (1 - frac) * central(jj) + frac * central(jj + 1)
+    
+    info = np.nansum(ivar * dmdrv**2)
+    
+    if info > 0:
+        return 1 / np.sqrt(info)
+    else:
+        return np.inf
+
+def _xcorr_template(wl, fl, ivar, corvmodel, params, min_rv, max_rv, npoints,
+                    fit_window = 25):
+    """
+    RV grid, normalized data, and the normalized model at every grid RV.
+    """
+    
+    rvgrid = np.linspace(min_rv, max_rv, npoints)
+    data = prepare_data(wl, fl, ivar, corvmodel, fit_window = fit_window)
+    _, template = models.get_normalized_model_batch(wl, corvmodel, params, 
+                                                    RV = rvgrid)
+    
+    return rvgrid, data, template
+
+def bootstrap_rv(wl, fl, ivar, corvmodel, params, nboot = 500, 
+                 mode = 'ivar', min_rv = -1500, max_rv = 1500, npoints = 500,
+                 quad_window = 300, percentiles = (16, 50, 84), seed = None):
+    """
+    RV uncertainty from many noise realizations of a spectrum. 
+    
+    The template is built once on the x-correlation grid (as in xcorr_rv), 
+    and the chi-square curves of all realizations are computed together 
+    with matrix products. Each realization's RV is the vertex of a 
+    quadratic fitted within quad_window of the data's chi-square minimum.
+
+    Parameters
+    ----------
+    wl : array_like
+        wavelengths in Angstroms.
+    fl : array_like
+        flux array.
+    ivar : array_like
+        inverse-variance.
+    corvmodel : LMFIT Model class
+        LMFIT model with normalization instructions.
+    params : LMFIT Parameters class
+        parameters at which to evaluate corvmodel.
+    nboot : int, optional
+        number of noise realizations. The default is 500.
+    mode : str, optional
+        'ivar' draws Gaussian noise from the inverse-variance, 'residual' 
+        resamples the error-scaled residuals of the best grid model. 
+        The default is 'ivar'.
+    min_rv, max_rv, npoints, quad_window : optional
+        RV grid and quadratic window, as in xcorr_rv.
+    percentiles : tuple, optional
+        lower, central and upper percentiles. The default is (16, 50, 84).
+    seed : int, optional
+        random seed. The default is None.
+
+    Returns
+    -------
+    rv : float
+        central percentile of the bootstrapped RVs.
+    e_rv_lo : float
+        distance from the lower to the central percentile.
+    e_rv_hi : float
+        distance from the central to the upper percentile.
+    rvs : array_like
+        RV of every realization.
+
+    """
+    
+    if mode not in ('ivar', 'residual'):
+        raise ValueError("mode must be 'ivar' or 'residual'")
+    
+    rvgrid, data, template = _xcorr_template(wl, fl, ivar, corvmodel, params,
+                                             min_rv, max_rv, npoints)
+    
+    rng = np.random.default_rng(seed)
+    
+    w = np.where(np.isfinite(data['fl']), data['ivar'], 0)
+    d = np.nan_to_num(data['fl'])
+    tmask = np.isfinite(template).astype(float)
+    t0 = np.nan_to_num(template)
+    
+    good = w > 0
+    sigma = np.zeros_like(w)
+    sigma[good] = 1 / np.sqrt(w[good])
+    
+    if mode == 'ivar':
+        ds = d + sigma * rng.standard_normal((nboot, len(d)))
+    elif mode == 'residual':
+        cc = (d**2 * w) @ tmask.T - 2 * (d * w) @ t0.T + (t0**2 * tmask) @ w
+        best = t0[np.argmin(cc)]
+        z = ((d - best) * np.sqrt(w))[good]
+        ds = np.tile(d, (nboot, 1))
+        ds[:, good] = best[good] + rng.choice(z, (nboot, good.sum())) * sigma[good]
+    
+    # chi^2[k, j] = sum_i w_i (d_ki - t_ji)^2, skipping NaN template pixels
+    cc = (ds**2 * w) @ tmask.T - 2 * (ds * w) @ t0.T + (t0**2 * tmask) @ w
+    
+    window = int(quad_window / np.diff(rvgrid)[0])
+    argmin = np.argmin(np.median(cc, axis = 0))
+    c1 = max(argmin - window, 0)
+    c2 = argmin + window + 1
+    
+    pcoef = np.polyfit(rvgrid[c1:c2], cc[:, c1:c2].T, 2)
+    rvs = - 0.5 * pcoef[1] / pcoef[0]
+    
+    # realizations without a well-defined minimum fall back to the grid
+    bad = ~(pcoef[0] > 0) | (rvs < rvgrid[c1]) | (rvs > rvgrid[c2 - 1])
+    rvs[bad] = rvgrid[np.argmin(cc[bad], axis = 1)]
+    
+    lo, mid, hi = np.percentile(rvs, percentiles)
+    
+    return mid, mid - lo, hi - mid, rvs
+
 def fit_rv(wl, fl, ivar, corvmodel, params, fix_nonrv = True, 
-           xcorr_kw = {}):
+           xcorr_kw = {}, cache = None, key = None, warm_window = 300,
+           fisher = False):
     """
     Use LMFIT to fit RV, after first estimating it by cross-correlation. 
 
@@ -203,18 +345,53 @@ def fit_rv(wl, fl, ivar, corvmodel, params, fix_nonrv = True,
         whether to fix all non-RV parameters. The default is True.
     xcorr_kw : dict, optional
         keywords to pass to xcorr_rv. The default is {}.
+    cache : FitCache, optional
+        warm-start cache. If it holds an RV for `key`, the x-correlation 
+        grid is restricted to +/- warm_window around it. The best RV is 
+        written back to the cache. The default is None.
+    key : str or int, optional
+        cache key, e.g. the catalog ID. The default is None.
+    warm_window : float, optional
+        half-width of the warm-started RV grid in km/s. The default is 300.
+    fisher : bool, optional
+        whether to also return the Fisher-information RV error. 
+        The default is False.
 
     Returns
     -------
-    res : LMFIT MinimzerResult class
-        rv-fitting results.
-    rv_init : float
-        initial guess RV from the x-correlation, for comparison purposes.
+    rv : float
+        best-fit radial velocity from the x-correlation.
+    e_rv : float
+        RV error from the chi-square parabola.
+    redchi : float
+        reduced chi-square at the best RV.
+    e_rv_fisher : float
+        Fisher-information RV error. Only returned if fisher is True.
 
     """
     
-    rv, e_rv, redchi, rvgrid, cc = xcorr_rv(wl, fl, ivar, corvmodel, params,
-                                   **xcorr_kw)
+    entry = cache.get(key) if (cache is not None and key is not None) else None
+    
+    if entry is not None and 'rv' in entry:
+        warm_kw = _warm_xcorr_kw(xcorr_kw, float(entry['rv']), warm_window)
+        rv, e_rv, redchi, rvgrid, cc, e_rv_fisher = xcorr_rv(wl, fl, ivar, 
+                                                             corvmodel, params,
+                                                             fisher = True,
+                                                             **warm_kw)
+        
+        # fall back to the full search if the minimum left the warm window
+        if e_rv == 999 or not (warm_kw['min_rv'] < rv < warm_kw['max_rv']):
+            entry = None
+    
+    if entry is None or 'rv' not in entry:
+        rv, e_rv, redchi, rvgrid, cc, e_rv_fisher = xcorr_rv(wl, fl, ivar, 
+                                                             corvmodel, params,
+                                                             fisher = True,
+                                                             **xcorr_kw)
+        
+    if cache is not None and key is not None:
+        cache.put(key, rv = rv, e_rv = e_rv, rv_redchi = redchi, 
+                  e_rv_fisher = e_rv_fisher)
     
     #if fix_nonrv:
     #    for param in params:
@@ -227,11 +404,15 @@ def fit_rv(wl, fl, ivar, corvmodel, params, fix_nonrv = True,
     
     #res = lmfit.minimize(residual, params)
     
+    if fisher:
+        return rv, e_rv, redchi, e_rv_fisher
+    
     return rv, e_rv, redchi
 
 def fit_corv(wl, fl, ivar, corvmodel, xcorr_kw = {},
                   iter_teff = False,
-                  tpar = dict(tmin = 10000, tmax = 20000, nt = 2)):
+                  tpar = dict(tmin = 10000, tmax = 20000, nt = 2),
+                  cache = None, key = None, compact = False, fisher = False):
     """
     Fit model parameters, x-corr RV, then LMFIT RV. 
 
@@ -252,11 +433,24 @@ def fit_corv(wl, fl, ivar, corvmodel, xcorr_kw = {},
     tpar : dict, optional
         initial teff iteration parameters. The default is 
         dict(tmin = 10000, tmax = 20000, nt = 2).
+    cache : FitCache, optional
+        warm-start cache. If it holds parameters for `key`, they are used 
+        as initial values (and the teff iteration is skipped). The best-fit 
+        parameters, covariance and RV are written back. The default is None.
+    key : str or int, optional
+        cache key, e.g. the catalog ID. The default is None.
+    compact : bool, optional
+        whether to return param_res as a FitResult instead of the full 
+        LMFIT MinimizerResult. The default is False.
+    fisher : bool, optional
+        whether to also return the Fisher-information RV error, after 
+        param_res. The default is False.
 
     Returns
     -------
     param_res : LMFIT MinimizerResult class
-        result of fit to parameters, allowing everything to vary.
+        result of fit to parameters, allowing everything to vary. A 
+        FitResult holding the RV as well if compact is True.
     rv_res : LMFIT MinimizerResult class
         result of RV fit from LMFIT.
     rv_init : float
@@ -264,12 +458,19 @@ def fit_corv(wl, fl, ivar, corvmodel, xcorr_kw = {},
 
     """
     
+    import lmfit
+    
     params = corvmodel.make_params()
     
     residual = lambda params: normalized_residual(wl, fl, ivar, 
                                                   corvmodel, params)
     
-    if iter_teff:
+    use_cache = cache is not None and key is not None
+    warm = use_cache and cache.init_params(key, params)
+    
+    if warm:
+        param_res = lmfit.minimize(residual, params)
+    elif iter_teff:
         minchi = 1e50
         init_teffs = np.linspace(tpar['tmin'], tpar['tmax'], tpar['nt'])
         for ii in range(tpar['nt']):
@@ -287,6 +488,371 @@ def fit_corv(wl, fl, ivar, corvmodel, xcorr_kw = {},
         
     bestparams = param_res.params.copy()
     
-    rv, e_rv, redchi = fit_rv(wl, fl, ivar, corvmodel, bestparams, **xcorr_kw)
+    rv, e_rv, redchi, e_rv_fisher = fit_rv(wl, fl, ivar, corvmodel, bestparams, 
+                                           xcorr_kw = xcorr_kw,
+                                           cache = cache if use_cache else None, 
+                                           key = key, fisher = True)
+    
+    if use_cache:
+        cache.put(key, param_res)
+        
+    if compact:
+        param_res = FitResult.from_lmfit(param_res, rv, e_rv, redchi, 
+                                         e_rv_fisher = e_rv_fisher)
+        
+    if fisher:
+        return rv, e_rv, redchi, param_res, e_rv_fisher
+            
+    return rv, e_rv, redchi, param_res
+
+def prepare_data(wl, fl, ivar, corvmodel, fit_window = None):
+    """
+    Crops and continuum-normalizes a spectrum around the model's lines. 
+    
+    This is the data side of normalized_residual, computed once so that
+    batched likelihoods can be evaluated against many models. 
+
+    Parameters
+    ----------
+    wl : array_like
+        wavelengths in Angstroms.
+    fl : array_like
+        flux array.
+    ivar : array_like
+        inverse-variance.
+    corvmodel : LMFIT Model class
+        LMFIT model with normalization instructions.
+    fit_window : float, optional
+        if given, only pixels within this many Angstroms of a line centre
+        keep their weight. The default is None.
+
+    Returns
+    -------
+    data : dict
+        normalized data with keys 'wl', 'fl' and 'ivar'.
+
+    """
+    
+    nwl, nfl, nivar = utils.cont_norm_lines(wl, fl, ivar,
+                                            corvmodel.names,
+                                            corvmodel.centres,
+                                            corvmodel.windows,
+                                            corvmodel.edges)
+    
+    if fit_window is not None:
+        centres = np.array(list(corvmodel.centres.values()))
+        in_center = np.any(np.abs(nwl[:, None] - centres[None, :]) < fit_window, 
+                           axis = 1)
+        nivar[~in_center] = 0
+    
+    return dict(wl = nwl, fl = nfl, ivar = nivar)
+
+def sample_corv(wl, fl, ivar, corvmodel, params = None, 
+                vary = ('RV', 'teff', 'logg'),
+                nwalkers = 32, nsteps = 2000, nburn = 500,
+                init_sigma = dict(RV = 10, teff = 100, logg = 0.05),
+                seed = None, progress = False):
+    """
+    Sample the posterior of RV and atmospheric parameters with emcee.
+    
+    The log-likelihood is vectorized: the models of all walkers are 
+    evaluated in one batched call (see models.get_normalized_model_batch)
+    against data normalized once with prepare_data. Priors are uniform 
+    within the parameter bounds of corvmodel. 
+
+    Parameters
+    ----------
+    wl : array_like
+        wavelengths in Angstroms.
+    fl : array_like
+        flux array.
+    ivar : array_like
+        inverse-variance.
+    corvmodel : LMFIT Model class
+        LMFIT model with normalization instructions.
+    params : LMFIT Parameters class, optional
+        starting point, e.g. the best fit from fit_corv. Parameters not in 
+        vary are held fixed here. The default is corvmodel.make_params().
+    vary : sequence of str, optional
+        parameters to sample. The default is ('RV', 'teff', 'logg').
+    nwalkers : int, optional
+        number of walkers. The default is 32.
+    nsteps : int, optional
+        number of steps per walker. The default is 2000.
+    nburn : int, optional
+        steps discarded from the start of each chain. The default is 500.
+    init_sigma : dict, optional
+        scatter of the initial walker positions around params. Parameters
+        not listed start within 0.1% of their value. 
+    seed : int, optional
+        random seed for the initial walker positions. The default is None.
+    progress : bool, optional
+        whether to show the emcee progress bar. The default is False.
+
+    Returns
+    -------
+    chain : array_like
+        flattened posterior samples with shape (n_samples, len(vary)), 
+        columns in the order of vary.
+    sampler : emcee EnsembleSampler class
+        the sampler, for diagnostics.
+
+    """
+    
+    try:
+        import emcee
+    except ImportError:
+        raise ImportError('sample_corv requires emcee (pip install corv[mcmc])')
+    
+    if params is None:
+        params = corvmodel.make_params()
+        
+    vary = list(vary)
+    ndim = len(vary)
+    
+    data = prepare_data(wl, fl, ivar, corvmodel)
+    
+    lo = np.array([params[name].min for name in vary])
+    hi = np.array([params[name].max for name in vary])
+    
+    def log_prob(theta):
+        lp = np.full(len(theta), -np.inf)
+        inb = np.all((theta > lo) & (theta < hi), axis = 1)
+        
+        if np.any(inb):
+            batch = {name: theta[inb, ii] for ii, name in enumerate(vary)}
+            _, nmodel = models.get_normalized_model_batch(wl, corvmodel, 
+                                                          params, **batch)
+            chi2 = np.nansum((data['fl'] - nmodel)**2 * data['ivar'], axis = 1)
+            lp[inb] = -0.5 * chi2
+            
+        return lp
+    
+    rng = np.random.default_rng(seed)
+    
+    p0 = np.array([params[name].value for name in vary])
+    sigma = np.array([init_sigma.get(name, 1e-3 * np.abs(params[name].value)) 
+                      for name in vary])
+    p0 = p0 + sigma * rng.standard_normal((nwalkers, ndim))
+    p0 = np.clip(p0, lo + 1e-6 * (hi - lo), hi - 1e-6 * (hi - lo))
+    
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, log_prob, vectorize = True)
+    sampler.run_mcmc(p0, nsteps, progress = progress)
+    
+    chain = sampler.get_chain(discard = nburn, flat = True)
+    
+    return chain, sampler
+
+def _warm_xcorr_kw(xcorr_kw, rv, warm_window):
+    """
+    xcorr_rv keywords for a grid of the same resolution, centred on rv.
+    """
+    
+    kw = dict(xcorr_kw)
+    min_rv = kw.get('min_rv', -1500)
+    max_rv = kw.get('max_rv', 1500)
+    npoints = kw.get('npoints', 500)
+    
+    step = (max_rv - min_rv) / (npoints - 1)
+    kw['min_rv'] = max(min_rv, rv - warm_window)
+    kw['max_rv'] = min(max_rv, rv + warm_window)
+    kw['npoints'] = max(int(round((kw['max_rv'] - kw['min_rv']) / step)) + 1, 3)
+    
+    return kw
+
+class FitCache:
+    """
+    On-disk store of best-fit parameters, keyed by catalog ID. 
+    
+    Every key is kept in its own .npz file under `path`, so that several
+    worker processes can share one cache. Entries hold the best-fit 
+    parameter values and errors, the covariance matrix, and the RV.
+    
+    Parameters
+    ----------
+    path : str
+        directory in which to keep the cache. Created if missing.
+
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+        
+    def _file(self, key):
+        return os.path.join(self.path, '%s.npz' % key)
+    
+    def __contains__(self, key):
+        return os.path.exists(self._file(key))
+    
+    def get(self, key):
+        """
+        Returns the cached entry for key as a dict of arrays, or None.
+        """
+        try:
+            with np.load(self._file(key)) as f:
+                return {name: f[name] for name in f.files}
+        except (OSError, ValueError):
+            return None
+    
+    def put(self, key, result = None, **fields):
+        """
+        Merges a fit result and/or extra fields into the entry for key.
+
+        Parameters
+        ----------
+        key : str or int
+            cache key.
+        result : LMFIT MinimizerResult or FitResult class, optional
+            parameter fit whose values, errors and covariance are stored.
+        **fields : 
+            extra scalars or arrays to store, e.g. rv = 132.
+
+        """
+        entry = self.get(key) or {}
+        
+        if isinstance(result, FitResult):
+            entry['names'] = np.array(result.names)
+            entry['values'] = result.values
+            entry['stderr'] = result.stderr
+            entry['redchi'] = np.array(result.redchi)
+        elif result is not None:
+            compact = FitResult.from_lmfit(result)
+            entry['names'] = np.array(compact.names)
+            entry['values'] = compact.values
+            entry['stderr'] = compact.stderr
+            entry['redchi'] = np.array(compact.redchi)
+            if result.covar is not None:
+                entry['covar'] = np.array(result.covar)
+                entry['var_names'] = np.array(result.var_names)
+                
+        for name, value in fields.items():
+            entry[name] = np.asarray(value)
+        
+        # write-then-rename, so readers never see a half-written entry
+        tmp = self._file(key) + '.%i.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.savez(f, **entry)
+        os.replace(tmp, self._file(key))
+        
+    def init_params(self, key, params):
+        """
+        Sets params to the cached best-fit values for key, in place.
+
+        Returns
+        -------
+        found : bool
+            whether any cached values were applied.
+
+        """
+        entry = self.get(key)
+        
+        if entry is None or 'names' not in entry:
+            return False
+        
+        for name, value in zip(entry['names'], entry['values']):
+            name = str(name)
+            if name in params and params[name].expr is None:
+                params[name].set(value = float(value))
+                
+        return True
+
+class FitResult:
+    """
+    Compact, picklable record of a parameter + RV fit. 
+    
+    Holds only what catalog runs use from an LMFIT MinimizerResult, so 
+    that results are cheap to send between processes and to keep in 
+    memory for many stars. Parameters tied by an expression are dropped.
+    Missing errors (e.g. from a failed covariance estimate) are NaN.
+
+    Parameters
+    ----------
+    names : sequence of str
+        parameter names.
+    values : array_like
+        best-fit parameter values.
+    stderr : array_like
+        parameter standard errors.
+    redchi : float, optional
+        reduced chi-square of the parameter fit.
+    nfev : int, optional
+        number of function evaluations.
+    success : bool, optional
+        whether the minimizer reported success.
+    rv, e_rv, rv_redchi : float, optional
+        RV, its error and the reduced chi-square from fit_rv, in km/s.
+    e_rv_fisher : float, optional
+        Fisher-information RV error from fit_rv, in km/s.
+
+    """
+    
+    __slots__ = ('names', 'values', 'stderr', 'redchi', 'nfev', 'success',
+                 'rv', 'e_rv', 'rv_redchi', 'e_rv_fisher')
+    
+    def __init__(self, names, values, stderr, redchi = np.nan, nfev = 0,
+                 success = False, rv = np.nan, e_rv = np.nan, 
+                 rv_redchi = np.nan, e_rv_fisher = np.nan):
+        self.names = tuple(str(name) for name in names)
+        self.values = np.asarray(values, dtype = float)
+        self.stderr = np.asarray(stderr, dtype = float)
+        self.redchi = float(redchi)
+        self.nfev = int(nfev)
+        self.success = bool(success)
+        self.rv = float(rv)
+        self.e_rv = float(e_rv)
+        self.rv_redchi = float(rv_redchi)
+        self.e_rv_fisher = float(e_rv_fisher)
+        
+    @classmethod
+    def from_lmfit(cls, result, rv = np.nan, e_rv = np.nan, 
+                   rv_redchi = np.nan, e_rv_fisher = np.nan):
+        """
+        Converts an LMFIT MinimizerResult (and optionally an RV triple).
+        """
+        names = [name for name in result.params 
+                 if result.params[name].expr is None]
+        values = [result.params[name].value for name in names]
+        stderr = [np.nan if result.params[name].stderr is None 
+                  else result.params[name].stderr for name in names]
+        
+        return cls(names, values, stderr, redchi = result.redchi, 
+                   nfev = result.nfev, success = result.success,
+                   rv = rv, e_rv = e_rv, rv_redchi = rv_redchi,
+                   e_rv_fisher = e_rv_fisher)
+    
+    def value(self, name):
+        return self.values[self.names.index(name)]
+    
+    def error(self, name):
+        return self.stderr[self.names.index(name)]
+    
+    def to_params(self, corvmodel):
+        """
+        LMFIT Parameters of corvmodel, set to the best-fit values.
+        """
+        params = corvmodel.make_params()
+        for name, value in zip(self.names, self.values):
+            if name in params and params[name].expr is None:
+                params[name].set(value = value)
+                
+        return params
+    
+    def to_dict(self, prefix = ''):
+        """
+        Flat dict of values, errors and fit statistics, for table rows.
+        """
+        ret = {}
+        for name, value, stderr in zip(self.names, self.values, self.stderr):
+            ret[prefix + name] = value
+            ret[prefix + name + '_err'] = stderr
+        for name in ('redchi', 'nfev', 'success', 'rv', 'e_rv', 'rv_redchi', 
+                     'e_rv_fisher'):
+            ret[prefix + name] = getattr(self, name)
             
-    return rv, e_rv, redchi, param_res
\ No newline at end of file
+        return ret
+    
+    def __repr__(self):
+        pars = ', '.join('%s=%.4g' % (name, value) 
+                         for name, value in zip(self.names, self.values))
+        return 'FitResult(%s, rv=%.2f +/- %.2f)' % (pars, self.rv, self.e_rv)
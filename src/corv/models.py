@@ -23,7 +23,6 @@ To-do:
 """
 
 import numpy as np
-from lmfit.models import Model, ConstantModel, VoigtModel
 import pickle
 import os
 import scipy 
@@ -78,6 +77,7 @@ def make_balmer_model(nvoigt=1,
         LMFIT-style model that can be evaluated and fitted.
 
     """
+    from lmfit.models import ConstantModel, VoigtModel
 
     model = ConstantModel()
 
@@ -114,10 +114,35 @@ def make_balmer_model(nvoigt=1,
 
 # Koester DA Model
 
-try:
-    wd_interp = pickle.load(open('/home/arseneau/research/white-dwarfs/corv-dev/models/koester_interp_da.pkl', 'rb'))
-except:
-    print('could not find pickled WD models')
+wd_interp_path = '/home/arseneau/research/white-dwarfs/corv-dev/models/koester_interp_da.pkl'
+
+def load_wd_interp():
+    """
+    Load the pickled Koester DA interpolator on first use and keep it as 
+    `models.wd_interp`; later calls return the loaded grid.
+
+    Returns
+    -------
+    wd_interp : callable
+        interpolator of log flux over (logg, log teff, log wavelength).
+
+    """
+    global wd_interp
+
+    if 'wd_interp' not in globals():
+        try:
+            with open(wd_interp_path, 'rb') as f:
+                wd_interp = pickle.load(f)
+        except OSError:
+            print('could not find pickled WD models')
+            raise
+
+    return wd_interp
+
+def __getattr__(name):
+    if name == 'wd_interp':
+        return load_wd_interp()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 def get_koester(x, teff, logg, RV, res):
     """
@@ -144,7 +169,7 @@ def get_koester(x, teff, logg, RV, res):
     flam = np.zeros_like(x_shifted) * np.nan
 
     in_bounds = (x_shifted > 3600) & (x_shifted < 9000)
-    flam[in_bounds] = 10**wd_interp((logg, np.log10(teff), np.log10(x_shifted[in_bounds])))
+    flam[in_bounds] = 10**load_wd_interp()((logg, np.log10(teff), np.log10(x_shifted[in_bounds])))
 
     flam = flam / np.nanmedian(flam) # bring to order unity
     
@@ -155,6 +180,49 @@ def get_koester(x, teff, logg, RV, res):
     
     return flam
 
+def get_koester_batch(x, teff, logg, RV, res):
+    """
+    Interpolates Koester (2010) DA models at many parameter sets at once.
+    
+    Equivalent to calling get_koester once per row, but with a single
+    interpolator call and a single convolution for the whole batch.
+
+    Parameters
+    ----------
+    x : array_like
+        wavelength in Angstrom.
+    teff, logg, RV, res : array_like or float
+        parameters, broadcast against each other to shape (n,).
+
+    Returns
+    -------
+    flam : array_like
+        synthetic fluxes with shape (n, len(x)).
+
+    """
+    teff, logg, RV, res = np.broadcast_arrays(*[np.atleast_1d(np.asarray(p, dtype = float))
+                                               for p in (teff, logg, RV, res)])
+    
+    df = np.sqrt((1 - RV/c_kms)/(1 + RV/c_kms))
+    x_shifted = x[None, :] * df[:, None]
+    
+    flam = np.zeros_like(x_shifted) * np.nan
+    
+    in_bounds = (x_shifted > 3600) & (x_shifted < 9000)
+    rows = np.nonzero(in_bounds)[0]
+    flam[in_bounds] = 10**load_wd_interp()((logg[rows], np.log10(teff[rows]), 
+                                              np.log10(x_shifted[in_bounds])))
+    
+    flam = flam / np.nanmedian(flam, axis = 1)[:, None]
+    
+    dx = np.median(np.diff(x))
+    
+    for r in np.unique(res):
+        sel = res == r
+        flam[sel] = scipy.ndimage.gaussian_filter1d(flam[sel], r / dx, axis = -1)
+    
+    return flam
+
 
 def make_koester_model(resolution = 1, centres = default_centres, 
                        windows = default_windows, 
@@ -183,6 +251,7 @@ def make_koester_model(resolution = 1, centres = default_centres,
         DESCRIPTION.
 
     """
+    from lmfit.models import Model
     
     model = Model(get_koester,
                   independent_vars = ['x'],
@@ -198,6 +267,7 @@ def make_koester_model(resolution = 1, centres = default_centres,
     model.windows = windows
     model.names = names
     model.edges = edges
+    model.batch_func = get_koester_batch
     
     return model
 
@@ -230,4 +300,53 @@ def get_normalized_model(wl, corvmodel, params):
                                   corvmodel.windows,
                                   corvmodel.edges)
     
+    return nwl, nfl
+
+def get_normalized_model_batch(wl, corvmodel, params, **batch):
+    """
+    Evaluates and continuum-normalizes a corvmodel at many parameter sets.
+    
+    Models with a `batch_func` attribute (e.g. the Koester model) are 
+    evaluated in one vectorized call; others fall back to one eval per row.
+
+    Parameters
+    ----------
+    wl : array_like
+        wavelength in Angstrom.
+    corvmodel : LMFIT model class
+        model class with line attributes defined.
+    params : LMFIT Parameters class
+        parameters for anything not given in batch.
+    **batch : array_like
+        parameter values to vary, each of shape (n,), e.g. RV = rvgrid.
+
+    Returns
+    -------
+    nwl : array_like
+        cropped wavelengths in Angstrom.
+    nfl : array_like
+        cropped and continuum-normalized fluxes with shape (n, len(nwl)).
+
+    """
+    nbatch = max([np.size(value) for value in batch.values()] + [1])
+    
+    if hasattr(corvmodel, 'batch_func'):
+        kw = {name: batch[name] if name in batch else params[name].value 
+              for name in corvmodel.param_names}
+        flux = corvmodel.batch_func(wl, **kw)
+        flux = np.broadcast_to(flux, (nbatch, len(wl)))
+    else:
+        flux = np.zeros((nbatch, len(wl)))
+        params = params.copy()
+        for ii in range(nbatch):
+            for name, value in batch.items():
+                params[name].set(value = np.broadcast_to(value, nbatch)[ii])
+            flux[ii] = corvmodel.eval(params, x = wl)
+    
+    nwl, nfl = utils.cont_norm_lines_batch(wl, flux,
+                                           corvmodel.names,
+                                           corvmodel.centres,
+                                           corvmodel.windows,
+                                           corvmodel.edges)
+    
     return nwl, nfl
\ No newline at end of file
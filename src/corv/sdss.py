@@ -11,16 +11,17 @@ Functions specific to SDSS-5, including data processing.
 # SPIN OFF THESE PATHS TO SWITCH BASED ON WHETHER LAPTOP OR HOLY
 
 import numpy as np
-from astropy.io import fits
-import astropy
+import warnings
+import hashlib
+import os
 import glob
-from astropy.table import Table
-from tqdm import tqdm
-import socket
-hostname = socket.gethostname()
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from . import spectral_resampling
 from . import utils
+from . import fit
+from .models import c_kms
 
 # if hostname[:4] == 'holy':
 # 	print('using holyoke paths')
@@ -36,14 +37,147 @@ from . import utils
 datapath = '/Users/vedantchandra/0_research/01_sdss5/006_build_corv/data/comm/'
 catpath = '/Users/vedantchandra/0_research/01_sdss5/006_build_corv/data/comm_cat/'
 
-print(catpath)
+####### DATA CONTEXT #############
 
-try:
-	starcat = Table.read(catpath + 'starcat.fits')
-	expcat = Table.read(catpath + 'expcat.fits')
-	#print('starcat has %i stars' % len(starcat))
-except:
-	print('star and exposure catalogs not found! check paths and run make_catalogs() if you want to use sdss functionality. otherwise ignore.')
+class DataContext:
+
+	# Paths and catalogs of one data release. Nothing is read when a context
+	# is made: starcat and expcat are read from catpath the first time they 
+	# are used, and the cid index into expcat is built on the first lookup. 
+	# store is an optional SpecStore (or the path of one, opened on first 
+	# use) that get_exposures reads from before falling back to FITS files. 
+	# By default catpath/specstore/ is used if it has been built; pass 
+	# store = False to always read the FITS files. make_catalogs repacks the 
+	# stars whose frames changed into an existing store, so run it (e.g. with
+	# incremental = True) after frames are re-reduced; until then the store 
+	# serves the old spectra. Use several contexts 
+	# to work with several data releases at once. 
+
+	def __init__(self, datapath = datapath, catpath = catpath, store = None):
+
+		self.datapath = datapath
+		self.catpath = catpath
+		self._store = store
+		self._starcat = None
+		self._expcat = None
+		self._index = None
+
+	def __repr__(self):
+
+		return 'DataContext(datapath = %r, catpath = %r)' % (self.datapath, self.catpath)
+
+	def _read(self, name):
+
+		from astropy.table import Table
+
+		path = self.catpath + name + '.fits'
+
+		if not os.path.exists(path):
+			raise FileNotFoundError('%s not found! check paths and run make_catalogs() '
+									'to use sdss functionality.' % path)
+
+		return Table.read(path)
+
+	@property
+	def starcat(self):
+
+		if self._starcat is None:
+			self._starcat = self._read('starcat')
+
+		return self._starcat
+
+	@starcat.setter
+	def starcat(self, table):
+
+		self._starcat = table
+
+	@property
+	def expcat(self):
+
+		if self._expcat is None:
+			self._expcat = self._read('expcat')
+
+		return self._expcat
+
+	@expcat.setter
+	def expcat(self, table):
+
+		self._expcat = table
+		self._index = None
+
+	@property
+	def store(self):
+
+		if self._store is None:
+			path = self.catpath + 'specstore/'
+			self._store = path if os.path.exists(path + 'index.npy') else False
+
+		if isinstance(self._store, str):
+			self._store = SpecStore(self._store)
+
+		return self._store if self._store is not False else None
+
+	def index(self):
+
+		# Sort expcat by (cid, TAI-BEG) and map every cid to its row range, so 
+		# that each star's exposures are a constant-time slice. Built on first 
+		# use; call it before starting a Pool so that forked workers share it. 
+
+		expcat = self.expcat
+		table = expcat[np.lexsort((expcat['TAI-BEG'], expcat['cid']))]
+		cids, starts, counts = np.unique(np.asarray(table['cid']), return_index = True, 
+										 return_counts = True)
+
+		rows = {int(cid): (start, start + count) for cid, start, count 
+				in zip(cids, starts, counts)}
+		self._index = (table, rows)
+
+		return self._index
+
+	def select(self, catalogid):
+
+		# rows of expcat for a catalogid, sorted by TAI-BEG
+
+		table, rows = self._index if self._index is not None else self.index()
+		start, stop = rows.get(int(catalogid), (0, 0))
+
+		return table[start:stop]
+
+_default_context = None
+
+def get_context(context = None):
+
+	# `context` if given, else the module default: a DataContext on the module
+	# datapath and catpath, remade if either of those has been changed
+
+	global _default_context
+
+	if context is not None:
+		return context
+
+	if (_default_context is None or _default_context.datapath != datapath 
+		or _default_context.catpath != catpath):
+		_default_context = DataContext(datapath, catpath)
+
+	return _default_context
+
+def set_context(context):
+
+	# Make `context` the default for every function called without one
+
+	global _default_context, datapath, catpath
+
+	datapath, catpath = context.datapath, context.catpath
+	_default_context = context
+
+def __getattr__(name):
+
+	# sdss.starcat and sdss.expcat are read from the default context on access
+
+	if name in ('starcat', 'expcat'):
+		return getattr(get_context(), name)
+
+	raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 
 ####### I/O FUNCTIONS #############
@@ -61,7 +195,18 @@ lamgrid = 10**loglamgrid
 break_wl = 5900
 log_break_wl = np.log10(break_wl)
 
-import lmfit
+# Doppler shifts of exposures are rounded to 1/shift_subpix of a loglamgrid 
+# pixel, i.e. to about rv_quantum km/s
+
+rv_quantum = 0.5
+dloglam = (loglamgrid[-1] - loglamgrid[0]) / (nwl - 1)
+shift_subpix = int(np.ceil(c_kms * np.log(10) * dloglam / rv_quantum))
+
+# Operators onto loglamgrid are built with shift_pad extra pixels at each end, 
+# so that a shift by up to shift_pad whole pixels (about 2200 km/s) is just an
+# offset into their rows
+
+shift_pad = 32
 
 # ADD HELIUM
 
@@ -77,6 +222,8 @@ default_names = ['hn', 'hz', 'he', 'hd', 'hg', 'hb', 'ha']
 
 def get_ew_line(wl, fl, ivar, line, window = 150, edge = 20, plot = False):
     
+    import lmfit
+    
     cwl, cfl, civar = utils.cont_norm_line(wl, fl, ivar, line, window, edge)
 
     model = lmfit.models.ConstantModel() - lmfit.models.VoigtModel(prefix = '')
@@ -99,6 +246,7 @@ def get_ew_line(wl, fl, ivar, line, window = 150, edge = 20, plot = False):
     
     if plot:
 
+        import matplotlib.pyplot as plt
         plt.plot(cwl, cfl, 'k.', label = 'Data')
         plt.plot(cwl, model.eval(params, x = cwl))
 
@@ -129,17 +277,19 @@ def get_ew_lines(wl, fl, ivar, names = default_names,
         ret[name + '_height'] = height
     return ret
 
-def get_ew_dict(cid):
-    exps = get_exposures(cid)
-
-    wl, fl, ivar = make_coadd(exps)
+def get_ew_dict(cid, context = None):
+    wl, fl, ivar = get_coadd(cid, context = context)
 
     ew_dict = get_ew_lines(wl, fl, ivar, plot = False)
     ew_dict['cid'] = cid
     
     return ew_dict
 
-def make_dacat(min_ew = 3, max_ew = 50):
+def make_dacat(min_ew = 3, max_ew = 50, context = None):
+
+	from astropy.table import Table
+
+	catpath = get_context(context).catpath
 
 	ewcat = Table.read(catpath + 'ewcat.fits')
 
@@ -161,133 +311,961 @@ def make_dacat(min_ew = 3, max_ew = 50):
 
 
 
-def get_exposure(bf, rf):
+class Exposure(dict):
+
+	# A single exposure: blue and red camera files merged at break_wl, as a 
+	# dict of arrays. Only the requested HDUs are read, through memory maps; 
+	# 'wdisp', 'sky', 'mask' and 'header' are otherwise read from the files 
+	# the first time they are accessed. Arrays keep the native dtype of the 
+	# files (float32), so cast where float64 is needed. 
+
+	hdus = dict(fl = 0, ivar = 1, mask = 2, logwl = 3, wdisp = 4, sky = 5)
+
+	def __init__(self, bf, rf, keys = ('logwl', 'fl', 'ivar')):
+
+		super().__init__()
+		self.bf = bf
+		self.rf = rf
+		self.load(keys)
+
+	def __missing__(self, key):
+
+		if key == 'header' or key in self.hdus:
+			self.load([key])
+		else:
+			raise KeyError(key)
+
+		return self[key]
+
+	def load(self, keys):
+
+		if len(keys) == 0:
+			return
+
+		from astropy.io import fits
+
+		with fits.open(self.bf, memmap = True) as b, fits.open(self.rf, memmap = True) as r:
+
+			if 'header' in keys:
+				self['header'] = dict(b[0].header)
+				keys = [key for key in keys if key != 'header']
+
+			bsel = b[self.hdus['logwl']].data < log_break_wl
+			rsel = r[self.hdus['logwl']].data > log_break_wl
+
+			for key in keys:
+				self[key] = np.concatenate((b[self.hdus[key]].data[bsel], 
+											r[self.hdus[key]].data[rsel]))
+
+def get_exposure(bf, rf, keys = ('logwl', 'fl', 'ivar', 'wdisp', 'sky', 'mask', 'header')):
 	
-	# Given a red and blue single exposure .fits file, return `exp` object
+	# Given a red and blue single exposure .fits file, return `exp` object.
+	# Only `keys` are read up front; anything else is read on first access.
 	
-	exp = {};
-
-	with fits.open(bf) as f:
-		
-		exp['header'] = dict(f[0].header)
-		
-		bwl = f[3].data
-		bfl = f[0].data
-		bivar = f[1].data
-		bdisp = f[4].data
-		bsky = f[5].data
-		bmask = f[2].data
-		
-	with fits.open(rf) as f:
-		
-		rwl = f[3].data
-		rfl = f[0].data
-		rmask = f[2].data
-		rivar = f[1].data
-		rdisp = f[4].data
-		rsky = f[5].data
-		
-	rsel = rwl > log_break_wl
-	bsel = bwl < log_break_wl
-		
-	exp['logwl'] = np.concatenate((bwl[bsel], rwl[rsel])).astype(float)
-	exp['fl'] = np.concatenate((bfl[bsel], rfl[rsel])).astype(float)
-	exp['ivar'] = np.concatenate((bivar[bsel], rivar[rsel])).astype(float)
-	exp['wdisp'] = np.concatenate((bdisp[bsel], rdisp[rsel])).astype(float)
-	exp['sky'] = np.concatenate((bsky[bsel], rsky[rsel])).astype(float)
-	exp['mask'] = np.concatenate((bmask[bsel], rmask[rsel])).astype(float)
-		
-	return exp
+	return Exposure(bf, rf, keys = keys)
 
-def get_exposures(catalogid):
+def get_exposures(catalogid, keys = ('logwl', 'fl', 'ivar'), store = None, 
+				  context = None):
 	
-	# Given a catalogid, get all exposures. Return exp data and table
+	# Given a catalogid, get all exposures. Return exp data and table. The
+	# header is not read, since it's in the table already. If a SpecStore is
+	# given (or, unless store = False, the context has one), the columns it holds are zero-copy 
+	# slices of it, and only other `keys` are read from the FITS files; 
+	# exposures not in the store are read from their FITS files. 
+	# Catalogs come from `context`, or the default DataContext. 
 	
-	seltable = expcat[expcat['cid'] == catalogid]
+	context = get_context(context)
+	store = context.store if store is None else store
+	store = None if store is False else store
+	seltable = context.select(catalogid)
 	expsdata = [];
-	expsheader = [];
-	
-	seltable = seltable[np.argsort(seltable['TAI-BEG'])]
 	
 	for ii,row in enumerate(seltable):
-		exp = get_exposure(row['bfile'], row['rfile'])
-		exp.pop('header') # no need to duplicate what's in the table already
+		stored = None
+		if store is not None:
+			stored = store.get(row['cid'], row['expid'])
+		if stored is None:
+			exp = get_exposure(row['bfile'], row['rfile'], keys = keys)
+		else:
+			exp = Exposure(row['bfile'], row['rfile'], 
+						   keys = [key for key in keys if key not in stored])
+			exp.update(stored)
 		expsdata.append(exp)
 			
 	exps = dict(data = expsdata, header = seltable)
 	
 	return exps
 
-def make_coadd(exps, method = 'ivar_mean'):
+class SpecStore:
+
+	# Packed, indexed store of all exposures, to avoid opening two small FITS
+	# files per exposure. Merged blue+red 'logwl', 'fl', 'ivar' and 'mask' 
+	# arrays are concatenated into blocks of block_size exposures, each 
+	# column of each block saved as one .npy file in `path`, and index.npy 
+	# records the (cid, expid, block, offset, length, mtime) of every 
+	# exposure, mtime being that of its newer frame when it was packed. 
+	# Blocks are memory-mapped, so get() returns zero-copy slices. Build one 
+	# with SpecStore.build(path, expcat), and repack the stars whose frames 
+	# changed with update(expcat, cids). 
+
+	columns = ('logwl', 'fl', 'ivar', 'mask')
+
+	def __init__(self, path):
+
+		self.path = path
+		self.index = np.load(os.path.join(path, 'index.npy'))
+		self.rows = {(int(cid), int(expid)): ii for ii, (cid, expid) in 
+					 enumerate(zip(self.index['cid'], self.index['expid']))}
+		self.blocks = {}
+
+	def _block(self, block):
+
+		if block not in self.blocks:
+			self.blocks[block] = {col: np.load(os.path.join(self.path, '%05i_%s.npy' % (block, col)),
+											   mmap_mode = 'r') for col in self.columns}
+
+		return self.blocks[block]
+
+	def __contains__(self, key):
+
+		return (int(key[0]), int(key[1])) in self.rows
+
+	def mtime(self, cid, expid):
+
+		# frame mtime (ns) of the stored copy of (cid, expid)
+
+		return int(self.index[self.rows[(int(cid), int(expid))]]['mtime'])
+
+	def get(self, cid, expid):
+
+		# exposure dict for (cid, expid), or None if it isn't in the store
+
+		ii = self.rows.get((int(cid), int(expid)))
+
+		if ii is None:
+			return None
+
+		entry = self.index[ii]
+		block = self._block(int(entry['block']))
+		sl = slice(int(entry['offset']), int(entry['offset'] + entry['length']))
+
+		return {col: block[col][sl] for col in self.columns}
+
+	index_dtype = [('cid', 'i8'), ('expid', 'i8'), ('block', 'i8'), ('offset', 'i8'), 
+				   ('length', 'i8'), ('mtime', 'i8')]
+
+	@classmethod
+	def _pack(cls, path, expcat, first_block = 0, block_size = 2000):
+
+		# Read every exposure in expcat once and write them as blocks 
+		# first_block, first_block + 1, ... of `path`, returning their index. 
+		# Exposures are stored in (cid, TAI-BEG) order, so a star's 
+		# exposures are contiguous on disk. 
+
+		from tqdm import tqdm
+
+		expcat = expcat[np.lexsort((expcat['TAI-BEG'], expcat['cid']))]
+		index = np.zeros(len(expcat), dtype = cls.index_dtype)
+
+		for block, start in enumerate(tqdm(range(0, len(expcat), block_size)), first_block):
+
+			arrays = {col: [] for col in cls.columns}
+			offset = 0
+
+			for ii in range(start, min(start + block_size, len(expcat))):
+				row = expcat[ii]
+				mtime = max(os.stat(row['bfile']).st_mtime_ns, os.stat(row['rfile']).st_mtime_ns)
+				exp = Exposure(row['bfile'], row['rfile'], keys = cls.columns)
+				for col in cls.columns:
+					arrays[col].append(exp[col])
+				index[ii] = (row['cid'], row['expid'], block, offset, len(exp['logwl']), mtime)
+				offset += len(exp['logwl'])
+
+			for col in cls.columns:
+				np.save(os.path.join(path, '%05i_%s.npy' % (block, col)), np.concatenate(arrays[col]))
+
+		return index
+
+	@classmethod
+	def _save_index(cls, path, index):
+
+		tmp = os.path.join(path, 'index.%i.tmp.npy' % os.getpid())
+		np.save(tmp, index)
+		os.replace(tmp, os.path.join(path, 'index.npy'))
+
+	@classmethod
+	def build(cls, path, expcat, block_size = 2000):
+
+		# Pack every exposure in expcat into a new store at `path`
+
+		os.makedirs(path, exist_ok = True)
+
+		index = cls._pack(path, expcat, block_size = block_size)
+		cls._save_index(path, index)
+
+		return cls(path)
+
+	def stale(self, expcat):
+
+		# cids in expcat with an exposure that is missing from the store, or 
+		# whose frames are newer than its stored copy
+
+		stale = []
+
+		for row in expcat:
+			key = (int(row['cid']), int(row['expid']))
+			mtime = max(os.stat(row['bfile']).st_mtime_ns, os.stat(row['rfile']).st_mtime_ns)
+			if key not in self.rows or mtime > self.index[self.rows[key]]['mtime']:
+				stale.append(key[0])
+
+		return np.unique(np.array(stale, dtype = int))
+
+	def update(self, expcat, cids, block_size = 2000):
+
+		# Repack the exposures of `cids` from their current frames in expcat, 
+		# e.g. the changed cids returned by an incremental make_catalogs. Their
+		# old copies are dropped from the index (but left in their blocks 
+		# until the store is rebuilt), so no stale spectrum is ever served. 
+
+		cids = np.asarray(cids, dtype = int)
+		keep = self.index[~np.isin(self.index['cid'], cids)]
+		expcat = expcat[np.isin(np.asarray(expcat['cid']), cids)]
+
+		first_block = int(np.max(self.index['block'])) + 1 if len(self.index) > 0 else 0
+		index = self._pack(self.path, expcat, first_block, block_size)
+		index = np.concatenate((keep, index))
+
+		self._save_index(self.path, index)
+		self.__init__(self.path)
+
+		return self
+
+def index_expcat(context = None):
+
+	# Build the cid index of the (default) context's expcat now rather than on 
+	# first lookup, e.g. before starting a Pool so that forked workers share it
+
+	get_context(context).index()
+
+def _select_exposures(catalogid, context = None):
+
+	# rows of expcat for a catalogid, sorted by TAI-BEG
+
+	return get_context(context).select(catalogid)
+
+def get_coadd(catalogid, method = 'ivar_mean', cache_dir = None, context = None, 
+			  exps = None, **coadd_kw):
+
+	# Cached make_coadd(get_exposures(catalogid)). Co-adds are stored in 
+	# cache_dir (default catpath/coadds/) under a key built from the 
+	# catalogid, its sorted expids, and the modification times of every 
+	# exposure file (for exposures served from the context's SpecStore, as 
+	# recorded when they were packed), prefixed by a hash of the method and keywords so that 
+	# each method has its own entry. Adding or re-reducing an exposure 
+	# changes the key, so stale co-adds are never returned; they are deleted 
+	# when the new co-add for the same method is written. fl and ivar are 
+	# kept as float32. Catalogs come from `context`, or the default 
+	# DataContext. If the exposures have already been read, pass them as 
+	# `exps` so that a cache miss does not read them again. 
+
+	context = get_context(context)
+
+	if cache_dir is None:
+		cache_dir = context.catpath + 'coadds/'
+
+	seltable = context.select(catalogid)
+	store = context.store
+
+	methodkey = hashlib.sha1(repr((method, sorted(coadd_kw.items()))).encode())
+	methodkey = methodkey.hexdigest()[:8]
+
+	key = hashlib.sha1()
+	key.update(repr((int(catalogid), sorted(int(expid) for expid in seltable['expid']))).encode())
+	for row in seltable:
+		if store is not None and (row['cid'], row['expid']) in store:
+			key.update(repr(store.mtime(row['cid'], row['expid'])).encode())
+			continue
+		for file in (row['bfile'], row['rfile']):
+			key.update(repr(os.stat(file).st_mtime_ns).encode())
+
+	path = os.path.join(cache_dir, '%i_%s_%s.npz' % (catalogid, methodkey, 
+													  key.hexdigest()[:16]))
+
+	if os.path.exists(path):
+		try:
+			with np.load(path) as f:
+				return lamgrid, f['fl'].astype(float), f['ivar'].astype(float)
+		except (OSError, ValueError, KeyError):
+			pass
+
+	if exps is None:
+		exps = get_exposures(catalogid, context = context)
+
+	wl, fl, ivar = make_coadd(exps, method = method, **coadd_kw)
+	fl, ivar = fl.astype(np.float32), ivar.astype(np.float32)
+
+	os.makedirs(cache_dir, exist_ok = True)
+
+	# Only co-adds made with the same method and keywords are stale; other 
+	# methods for this star keep their own entries
+	for stale in glob.glob(os.path.join(cache_dir, '%i_%s_*.npz' % (catalogid, methodkey))):
+		os.remove(stale)
+
+	tmp = path + '.%i.tmp' % os.getpid()
+	with open(tmp, 'wb') as f:
+		np.savez(f, fl = fl, ivar = ivar)
+	os.replace(tmp, path)
+
+	return wl, fl.astype(float), ivar.astype(float)
+
+def load_star(catalogid, method = 'ivar_mean', context = None):
+
+	# Everything needed from disk to fit one star: its exposures (with 
+	# 'logwl', 'fl' and 'ivar' read into memory) and its cached co-add
+
+	exps = get_exposures(catalogid, context = context)
+
+	return exps, get_coadd(catalogid, method = method, context = context, 
+						   exps = exps)
+
+def prefetch(func, items, nahead = 4, nthreads = 2):
+
+	# Yield (item, func(item)) in order, while func runs on up to `nahead` of 
+	# the following items on `nthreads` background threads. Reading the next 
+	# items then overlaps with whatever the caller does with this one, and 
+	# at most nahead + 2 results are held in memory (the one being used and 
+	# nahead + 1 in flight). An exception in func is raised when its item is 
+	# reached. 
+
+	items = iter(items)
+	pool = ThreadPoolExecutor(nthreads)
+	pending = deque()
+
+	try:
+
+		for item in items:
+			pending.append((item, pool.submit(func, item)))
+			if len(pending) > nahead:
+				break
+
+		while pending:
+			item, future = pending.popleft()
+			for nextitem in items:
+				pending.append((nextitem, pool.submit(func, nextitem)))
+				break
+			yield item, future.result()
+
+	finally:
+		# If the caller stops early, drop the reads that have not started 
+		# yet (ThreadPoolExecutor only gained cancel_futures in 3.9)
+		for _, future in pending:
+			future.cancel()
+		pool.shutdown(wait = True)
+
+def prefetch_stars(catalogids, nahead = 4, nthreads = 2, method = 'ivar_mean', 
+				   context = None):
+
+	# Iterate over (catalogid, load_star(catalogid)), reading up to `nahead` 
+	# stars ahead of the one being used, e.g. while it is being fitted
+
+	context = get_context(context)
+
+	if context._index is None:
+		context.index()
+
+	load = lambda catalogid: load_star(catalogid, method = method, context = context)
+
+	return prefetch(load, catalogids, nahead = nahead, nthreads = nthreads)
+
+def make_coadd(exps, method = 'ivar_mean', nsigma = 5, maxiters = 3, 
+			   return_nexp = False, rvs = None):
 	
+	# Resample exposures onto loglamgrid and combine them. method is one of
+	# 'ivar_mean', 'mean', 'median' or 'sigclip_ivar_mean'; the last rejects 
+	# exposures more than nsigma of their own sigma from the per-pixel median, 
+	# for up to maxiters iterations, then takes the ivar-weighted mean. If 
+	# return_nexp, also returns the number of exposures used at each pixel. 
+	# If rvs (km/s, one per exposure) are given, each exposure is shifted to 
+	# the rest frame before co-adding. 
+
 	# Todo: add WDISP here too
-	# Todo: some way to pass velocities here to shift and then co-add
-	# Todo: add different coadding methods: median, inverse variance mean. 
 	
+	fls, sigmas = _resample_exposures(exps, rvs = rvs)
+
+	fl, ivar, ngood = _combine(fls, sigmas, method, nsigma = nsigma, maxiters = maxiters)
+	
+	if return_nexp:
+		return lamgrid, fl, ivar, ngood
+
+	return lamgrid, fl, ivar
+
+def make_group_coadds(exps, gap = 0.5, labels = None, method = 'ivar_mean',
+					  nsigma = 5, maxiters = 3, rvs = None, return_nexp = False):
+
+	# Co-add exposures in groups, e.g. one co-add per night. Groups are split
+	# wherever consecutive TAI-BEG differ by more than gap (in days), or are 
+	# given explicitly as one label per exposure. Every exposure is resampled
+	# once, and all groups are combined from that single pass. Returns 
+	# lamgrid, (n_groups, nwl) fl and ivar arrays, and the group labels 
+	# (plus the (n_groups, nwl) exposure counts if return_nexp). 
+
 	nexp = len(exps['data'])
 
+	if labels is None:
+		taibeg_mjd = np.asarray(exps['header']['TAI-BEG'], dtype = float) / 86400
+		order = np.argsort(taibeg_mjd)
+		breakpoints = np.diff(taibeg_mjd[order]) > gap
+		labels = np.zeros(nexp, dtype = int)
+		labels[order] = np.concatenate(([0], np.cumsum(breakpoints)))
+
+	groups, inverse = np.unique(np.asarray(labels), return_inverse = True)
+
+	fls, sigmas = _resample_exposures(exps, rvs = rvs)
+
+	fl = np.zeros((len(groups), nwl))
+	ivar = np.zeros((len(groups), nwl))
+	ngood = np.zeros((len(groups), nwl), dtype = int)
+
+	for gg in range(len(groups)):
+		sel = inverse == gg
+		fl[gg], ivar[gg], ngood[gg] = _combine(fls[sel], sigmas[sel], method, 
+											   nsigma = nsigma, maxiters = maxiters)
+
+	if return_nexp:
+		return lamgrid, fl, ivar, groups, ngood
+
+	return lamgrid, fl, ivar, groups
+
+def _resample_exposures(exps, rvs = None):
+
+	# Resample every exposure onto loglamgrid, returning (nexp, nwl) fluxes and
+	# sigmas. Exposures that share a grid and shift share one operator, and 
+	# are resampled together with a single sparse product. 
+
+	nexp = len(exps['data'])
+
+	if rvs is None:
+		rvs = np.zeros(nexp)
+
 	fls = np.zeros((nexp, nwl))
 	sigmas = np.zeros((nexp, nwl))
 
+	groups = {}
+
 	for ii,exp in enumerate(exps['data']):
+		op, start = _shift_operator(exp['logwl'], rvs[ii])
+		groups.setdefault((id(op), start), (op, start, []))[2].append(ii)
+
+	for op, start, idx in groups.values():
+
+		exp_fls = np.stack([exps['data'][ii]['fl'] for ii in idx])
+		exp_ivars = np.stack([exps['data'][ii]['ivar'] for ii in idx])
 
 		with np.errstate(divide='ignore'):
-			fl_i, sigma_i = spectral_resampling.spectres(loglamgrid, exp['logwl'], exp['fl'], np.reciprocal(np.sqrt(exp['ivar'])))
+			fl, sigma = op.apply(exp_fls, np.reciprocal(np.sqrt(exp_ivars)))
 
-		fls[ii, :] = fl_i
-		sigmas[ii, :] = sigma_i
+		fls[idx], sigmas[idx] = fl[:, start:start + nwl], sigma[:, start:start + nwl]
 
-	fl = np.zeros(nwl)
-	sigma = np.zeros(nwl)
-	mask = np.ones(nwl).astype(bool)
-	#nexps = np.zeros(nwl)
+	return fls, sigmas
 
-	for px in range(nwl):
-				
-		fl_px = fls[:, px]
-		sigma_px = sigmas[:, px]
-		
-		# sigma clipping? disabled for now.. 
-		# fl_px_clipped, lb, ub = stats.sigmaclip(fl_px, low = 5.0, high = 5.0)
-		# sigma_px = sigma_px[(fl_px > lb) & (fl_px < ub)]
-		# fl_px = fl_px_clipped
-						
-		goodmask = np.isfinite(sigma_px)
-		goodmask *= (fl_px > 0)
-		ngood = np.sum(goodmask)
-		#nexps[px] = ngood
-
-		if ngood > 0:
-
-			if method == 'median':
-				fl[px] = np.median(fl_px[goodmask])
-				sigma[px] = np.sqrt(np.sum(sigma_px[goodmask]**2)) / ngood # CHECK MATH HERE, ERROR ON MEDIAN? 
-			elif method == 'mean':
-				fl[px] = np.mean(fl_px[goodmask])
-				sigma[px] = np.sqrt(np.sum(sigma_px[goodmask]**2)) / ngood
-			elif method == 'ivar_mean':
-				fl[px] = np.average(fl_px[goodmask], weights = 1/sigma_px[goodmask]**2)
-				sigma[px] = np.sqrt(1 / np.sum(1/sigma_px[goodmask]**2))
-			else:
-				print('invalid method!')
+def _shift_operator(logwl, rv = 0):
+
+	# Operator resampling an exposure on logwl, shifted to the rest frame of 
+	# `rv`, onto loglamgrid. The rest-frame logwl is logwl + shift, and 
+	# resampling it onto loglamgrid is the same as resampling logwl onto 
+	# loglamgrid - shift. On the uniform loglamgrid, the whole-pixel part of 
+	# the shift only offsets the rows, so one operator onto the padded grid 
+	# serves every shift with the same sub-pixel remainder. The remainder is 
+	# rounded to 1/shift_subpix of a pixel. Unshifted operators are cached on
+	# disk; the others are only kept in a small in-memory cache. 
+	# Returns the operator and the row of loglamgrid[0]. 
+
+	logwl = np.asarray(logwl, dtype = float)
+	shift = 0.5 * np.log10((1 - rv / c_kms) / (1 + rv / c_kms))
+	pixels = np.round(-shift / dloglam * shift_subpix) / shift_subpix
+
+	whole = int(np.floor(pixels))
+	sub = int(np.round((pixels - whole) * shift_subpix))
+
+	if sub == shift_subpix:
+		whole, sub = whole + 1, 0
+
+	if abs(whole) > shift_pad:
+		# shifts beyond the padding get an operator of their own
+		newgrid = loglamgrid + dloglam * pixels
+		return spectral_resampling.get_operator(newgrid, logwl, persist = False), 0
+
+	newgrid = loglamgrid[0] + dloglam * (np.arange(-shift_pad, nwl + shift_pad) + sub / shift_subpix)
+	op = spectral_resampling.get_operator(newgrid, logwl, persist = (sub == 0))
+
+	return op, shift_pad + whole
+
+def shift_and_add(exps, corvmodel, niter = 3, method = 'ivar_mean', tol = 1,
+				  fit_kw = {}, wlrange = (3750, 8500)):
+
+	# Iteratively co-add exposures in the rest frame: co-add with the current 
+	# RVs, fit corvmodel to the co-add, re-fit each exposure's RV against that
+	# template, and repeat until the RVs change by less than tol (km/s) or 
+	# niter passes are done. The first pass co-adds without shifts. Exposure 
+	# RVs are searched with the same xcorr_kw (if any) as the co-add fit. 
+	# Exposure arrays are cropped once, and every pass reuses each exposure's
+	# cached operator for shifts with the same sub-pixel remainder (see 
+	# _shift_operator). 
+	# Returns the final co-add, the per-exposure RVs and their errors, and 
+	# the LMFIT result of the last co-add fit. 
+
+	nexp = len(exps['data'])
+	rvs = np.zeros(nexp)
+	e_rvs = np.full(nexp, np.nan)
+
+	# rest-frame-independent exposure data, cropped once
+
+	exp_data = []
+
+	for exp in exps['data']:
+		wl_i = 10**exp['logwl'].astype(float)
+		wlsel = (wl_i > wlrange[0]) & (wl_i < wlrange[1])
+		exp_data.append((wl_i[wlsel], exp['fl'][wlsel].astype(float), 
+						 exp['ivar'][wlsel].astype(float)))
+
+	for ii in range(niter):
+
+		wl, fl, ivar = make_coadd(exps, method = method, rvs = rvs)
+		param_res = fit.fit_corv(wl, fl, ivar, corvmodel, **fit_kw)[3]
+
+		new_rvs = np.zeros(nexp)
+
+		for jj, (wl_i, fl_i, ivar_i) in enumerate(exp_data):
+			new_rvs[jj], e_rvs[jj], _ = fit.fit_rv(wl_i, fl_i, ivar_i, corvmodel, 
+												   param_res.params.copy(),
+												   xcorr_kw = fit_kw.get('xcorr_kw', {}))
+
+		converged = np.all(np.abs(new_rvs - rvs) < tol)
+		rvs = new_rvs
+
+		if converged:
+			break
 
+	wl, fl, ivar = make_coadd(exps, method = method, rvs = rvs)
+
+	return wl, fl, ivar, rvs, e_rvs, param_res
+
+def _combine(fls, sigmas, method, nsigma = 5, maxiters = 3):
+
+	# Combine resampled (nexp, nwl) fluxes and errors across exposures, for 
+	# all pixels at once. Pixels count as good where sigma is finite and flux 
+	# is positive. Where no exposure is good, fl is NaN and ivar is 0. 
+
+	good = np.isfinite(sigmas) & (fls > 0)
+
+	if method == 'sigclip_ivar_mean':
+		good = _sigclip(fls, sigmas, good, nsigma, maxiters)
+		method = 'ivar_mean'
+
+	sums = _accumulate(fls, sigmas, good)
+
+	if method == 'median':
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', RuntimeWarning) # all-NaN pixels
+			median = np.nanmedian(np.where(good, fls, np.nan), axis = 0)
+		return _from_sums(sums, method, median = median)
+
+	return _from_sums(sums, method)
+
+def _accumulate(fls, sigmas, good):
+
+	# Per-pixel sums over the good exposures, from which the mean and 
+	# ivar_mean co-adds (and the error on the median) follow. 
+
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		weights = np.where(good, 1 / sigmas**2, 0)
+		fls = np.where(good, fls, 0)
+		return dict(sum_w = np.sum(weights, axis = 0),
+					sum_wf = np.sum(weights * fls, axis = 0),
+					sum_f = np.sum(fls, axis = 0),
+					sum_s2 = np.sum(np.where(good, sigmas**2, 0), axis = 0),
+					ngood = np.sum(good, axis = 0))
+
+def _from_sums(sums, method, median = None):
+
+	ngood = sums['ngood']
+	mask = ngood > 0 # where mask == False, there is zero usable data
+
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+		if method == 'median':
+			fl = np.array(median, dtype = float)
+			sigma = np.sqrt(sums['sum_s2']) / ngood # CHECK MATH HERE, ERROR ON MEDIAN? 
+		elif method == 'mean':
+			fl = sums['sum_f'] / ngood
+			sigma = np.sqrt(sums['sum_s2']) / ngood
+		elif method == 'ivar_mean':
+			fl = sums['sum_wf'] / sums['sum_w']
+			sigma = np.sqrt(1 / sums['sum_w'])
 		else:
-			mask[px] = False # where mask == False, there is zero usable data
-			fl[px] = np.nan
-			sigma[px] = np.inf
-			
-	ivar = 1 / sigma**2
+			raise ValueError('invalid method %s!' % method)
+
+		fl[~mask] = np.nan
+		sigma[~mask] = np.inf
+
+		ivar = 1 / sigma**2
+		
 	ivar[~mask] = 0.0
-	
-	return lamgrid, fl, ivar
+
+	return fl, ivar, ngood
+
+def _sigclip(fls, sigmas, good, nsigma, maxiters):
+
+	# Iteratively reject exposures further than nsigma * sigma from the 
+	# per-pixel median of the surviving exposures, for all pixels at once. 
+	# Pixels with fewer than 3 good exposures are left alone, since there the
+	# median cannot tell the outlier apart. 
+
+	clippable = np.sum(good, axis = 0) >= 3
+
+	for ii in range(maxiters):
+
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', RuntimeWarning) # all-NaN pixels
+			centre = np.nanmedian(np.where(good, fls, np.nan), axis = 0)
+
+		with np.errstate(invalid = 'ignore'):
+			keep = np.abs(fls - centre) <= nsigma * sigmas
+
+		new_good = good & (keep | ~clippable)
+
+		if np.array_equal(new_good, good):
+			break
+
+		good = new_good
+
+	return good
+
+class Coadder:
+
+	# Streaming co-add on loglamgrid. Exposures are added one at a time (or a 
+	# few at a time), and only running per-pixel sums are kept, so memory is 
+	# O(nwl) however many exposures are added. The current co-add can be 
+	# produced at any point, and the state can be saved and re-loaded to add 
+	# new nights without re-reading or re-resampling earlier exposures. 
+	# The 'median' and 'sigclip_ivar_mean' methods need every resampled 
+	# exposure, so they are only available with keep_exposures = True. 
+
+	def __init__(self, keep_exposures = False):
+
+		self.keep_exposures = keep_exposures
+		self.nexp = 0
+		self.sums = dict(sum_w = np.zeros(nwl), sum_wf = np.zeros(nwl), 
+						 sum_f = np.zeros(nwl), sum_s2 = np.zeros(nwl), 
+						 ngood = np.zeros(nwl, dtype = int))
+		self.fls = []
+		self.sigmas = []
+
+	def add(self, exp, rv = 0):
+
+		# add a single exposure dict, shifted to the rest frame by rv (km/s)
+
+		self.add_exposures(dict(data = [exp]), rvs = [rv])
+
+	def add_exposures(self, exps, rvs = None):
+
+		fls, sigmas = _resample_exposures(exps, rvs = rvs)
+		self.add_resampled(fls, sigmas)
+
+	def add_resampled(self, fls, sigmas):
+
+		# add exposures already resampled onto loglamgrid, shape (nexp, nwl)
+
+		fls = np.atleast_2d(fls)
+		sigmas = np.atleast_2d(sigmas)
+
+		good = np.isfinite(sigmas) & (fls > 0)
+		sums = _accumulate(fls, sigmas, good)
+
+		for key in self.sums:
+			self.sums[key] += sums[key]
+
+		self.nexp += len(fls)
+
+		if self.keep_exposures:
+			self.fls.extend(fls)
+			self.sigmas.extend(sigmas)
+
+	def coadd(self, method = 'ivar_mean', nsigma = 5, maxiters = 3, 
+			  return_nexp = False):
+
+		# same return values as make_coadd
+
+		if method in ('median', 'sigclip_ivar_mean'):
+			if not self.keep_exposures:
+				raise ValueError('method %s needs Coadder(keep_exposures = True)' % method)
+			fl, ivar, ngood = _combine(np.array(self.fls), np.array(self.sigmas), 
+									   method, nsigma = nsigma, maxiters = maxiters)
+		else:
+			fl, ivar, ngood = _from_sums(self.sums, method)
+
+		if return_nexp:
+			return lamgrid, fl, ivar, ngood
+
+		return lamgrid, fl, ivar
+
+	def save(self, path):
+
+		state = dict(self.sums)
+		state['nexp'] = self.nexp
+		state['keep_exposures'] = self.keep_exposures
+
+		if self.keep_exposures:
+			state['fls'] = np.array(self.fls).reshape(-1, nwl)
+			state['sigmas'] = np.array(self.sigmas).reshape(-1, nwl)
+
+		with open(path, 'wb') as f:
+			np.savez(f, **state)
+
+	@classmethod
+	def load(cls, path):
+
+		with np.load(path) as f:
+			coadder = cls(keep_exposures = bool(f['keep_exposures']))
+			coadder.nexp = int(f['nexp'])
+			for key in coadder.sums:
+				coadder.sums[key] = f[key]
+			if coadder.keep_exposures:
+				coadder.fls = list(f['fls'])
+				coadder.sigmas = list(f['sigmas'])
+
+		return coadder
 
 ####### CATALOG CONSTRUCTION #############
 
+# Primary header keywords copied into filecat (and from there expcat). These are 
+# the header columns of `keepcol` in make_corvcat.py; pass header_keys = None to 
+# make_catalogs to keep every keyword instead. 
+
+header_keys = ('AIRMASS', 'ALT', 'AZ', 'DATE-OBS', 'DEC', 'EXPTIME', 'G_DR2', 
+			   'HELIO_RV', 'IPA', 'MJD', 'PLATEID', 'QUALITY', 'RA', 'SDSSNAME', 
+			   'SRVYMODE', 'TAI-BEG', 'TAI-END')
+
+fits_block = 2880
+fits_card = 80
+
+def read_header(file, keys = header_keys, return_hash = False):
+
+	# Read the primary header of a FITS file as a dict without opening the 
+	# HDUs. Blocks are read one at a time until the END card (or until every 
+	# key is found), and only cards in `keys` are parsed. keys = None keeps 
+	# every valued card; commentary and HIERARCH cards are skipped. 
+	# return_hash also returns a SHA-1 of the raw header blocks. 
+
+	from astropy.io import fits
+
+	keys = None if keys is None else set(keys)
+	header = {}
+	digest = hashlib.sha1()
+
+	with open(file, 'rb') as f:
+
+		while True:
+
+			block = f.read(fits_block)
+			digest.update(block)
+
+			if len(block) < fits_block:
+				raise OSError('%s: primary header has no END card' % file)
+
+			for ii in range(0, fits_block, fits_card):
+
+				card = block[ii:ii + fits_card]
+				key = card[:8].decode('ascii').rstrip()
+
+				if key == 'END':
+					return (header, digest.hexdigest()) if return_hash else header
+
+				if card[8:10] != b'= ' or key in header:
+					continue
+				if keys is not None and key not in keys:
+					continue
+
+				header[key] = fits.Card.fromstring(card.decode('ascii')).value
+
+				if not return_hash and keys is not None and len(header) == len(keys):
+					return header
+
+def scan_headers(files, keys = header_keys, nthreads = 8, window = None, 
+				 return_hash = False):
+
+	# Yield read_header() for each file, in order, reading `nthreads` files at 
+	# a time. At most `window` (default 4 * nthreads) reads are in flight, so 
+	# memory stays bounded however many files there are. 
+
+	window = 4 * nthreads if window is None else window
+
+	with ThreadPoolExecutor(nthreads) as pool:
+
+		pending = deque()
+
+		for file in files:
+			pending.append(pool.submit(read_header, file, keys, return_hash))
+			if len(pending) >= window:
+				yield pending.popleft().result()
+
+		while pending:
+			yield pending.popleft().result()
+
+def _scan_filecat(files, header_keys = header_keys, nthreads = 8):
+
+	# filecat rows for a list of frames, and the SHA-1 of each primary header
+
+	from astropy.table import Table
+	from tqdm import tqdm
+
+	scanned = list(tqdm(scan_headers(files, header_keys, nthreads, return_hash = True), 
+						total = len(files)))
+	headers = [header for header, _ in scanned]
+
+	if header_keys is None:
+		keys = list(dict.fromkeys(key for header in headers for key in header))
+	else:
+		keys = list(header_keys)
+
+	filecat = Table()
+
+	for key in keys:
+		values = [header.get(key) for header in headers]
+		if any(value is not None for value in values):
+			filecat[key] = _header_column(values)
+
+	names = [os.path.basename(file).split('.')[0].split('-') for file in files]
+
+	filecat['filepath'] = np.array(files, dtype = str)
+	filecat['cid'] = np.array([int(name[-3]) for name in names], dtype = int)
+	filecat['camera'] = np.array([name[-2] for name in names], dtype = str)
+	filecat['expid'] = np.array([int(name[-1]) for name in names], dtype = int)
+
+	return filecat, np.array([digest for _, digest in scanned], dtype = str)
+
+def _make_manifest(files, hashes):
+
+	# (path, size, mtime, header hash) of every frame that went into filecat
+
+	from astropy.table import Table
+
+	stats = [os.stat(file) for file in files]
+
+	manifest = Table()
+	manifest['filepath'] = np.array(files, dtype = str)
+	manifest['size'] = np.array([stat.st_size for stat in stats], dtype = int)
+	manifest['mtime'] = np.array([stat.st_mtime for stat in stats], dtype = float)
+	manifest['header_hash'] = np.array(hashes, dtype = str)
+
+	return manifest
+
+def _update_filecat(files, filecat, manifest, header_keys = header_keys, nthreads = 8):
+
+	# Rescan only frames that are new or whose size or mtime differ from the 
+	# manifest, and count a frame as changed only if its header hash did too. 
+	# Returns the merged filecat, the new manifest, and the cids whose frames 
+	# were added, changed, or removed. 
+
+	from astropy.table import vstack
+
+	files = np.array(files, dtype = str)
+	current = _make_manifest(files, np.zeros(len(files), dtype = str))
+
+	known = dict(zip(np.asarray(manifest['filepath']).astype(str), range(len(manifest))))
+	idx = np.array([known.get(file, -1) for file in files], dtype = int)
+	seen = idx >= 0
+
+	stale = ~seen
+	stale[seen] = ((current['size'][seen] != manifest['size'][idx[seen]]) | 
+				   (current['mtime'][seen] != manifest['mtime'][idx[seen]]))
+
+	hashes = np.zeros(len(files), dtype = 'U40')
+	hashes[seen] = np.asarray(manifest['header_hash']).astype(str)[idx[seen]]
+
+	print('rescanning %i of %i frames' % (np.sum(stale), len(files)))
+
+	scanned, scanned_hashes = _scan_filecat(list(files[stale]), header_keys, nthreads)
+
+	changed = scanned_hashes != hashes[stale]
+	hashes[stale] = scanned_hashes
+	current['header_hash'] = hashes
+
+	paths = np.asarray(filecat['filepath']).astype(str)
+	removed = ~np.isin(paths, files)
+	replaced = np.isin(paths, files[stale][changed])
+
+	changed_cids = np.union1d(np.asarray(filecat['cid'])[removed | replaced], 
+							  scanned['cid'][changed])
+
+	filecat = filecat[~(removed | replaced)]
+
+	if np.any(changed):
+		filecat = vstack([filecat, scanned[changed]])
+
+	filecat = filecat[np.argsort(np.asarray(filecat['filepath']).astype(str), kind = 'stable')]
+
+	return filecat, current, changed_cids.astype(int)
+
+def _header_column(values):
+
+	# One filecat column from per-file header values; missing keywords are masked
+
+	from astropy.table import MaskedColumn
+
+	missing = [value is None for value in values]
+
+	if not any(missing):
+		return np.array(values)
+
+	fill = next(value for value in values if value is not None)
+	fill = type(fill)() if not isinstance(fill, bool) else False
+	values = [fill if value is None else value for value in values]
+
+	return MaskedColumn(values, mask = missing)
+
+def _group(*keys):
+
+	# Stable sort on keys (the last key is primary, as in np.lexsort). Returns 
+	# the sort order, where each group starts in it, and each sorted row's group. 
+
+	order = np.lexsort([np.asarray(key) for key in keys])
+	new = np.zeros(len(order), dtype = bool)
+	new[:1] = True
+
+	for key in keys:
+		key = np.asarray(key)[order]
+		new[1:] |= key[1:] != key[:-1]
+
+	return order, np.flatnonzero(new), np.cumsum(new) - 1
+
+def _group_median(values, key, starts, counts):
+
+	# Median of values within each group of key, given that group's start and 
+	# size from _group(key): sort by (key, value) and average the middle pair
+
+	values = np.asarray(values)
+	values = values[np.lexsort((values, np.asarray(key)))]
+
+	return 0.5 * (values[starts + (counts - 1) // 2] + values[starts + counts // 2])
 
 def make_catalogs(make_filecat = True, make_expcat = True, make_starcat = True,
-	catpath = catpath, datapath = datapath):
+	catpath = catpath, datapath = datapath, make_specstore = False, 
+	header_keys = header_keys, nthreads = 8, incremental = False):
 
 	# Make filecat, expcat, and starcat given the datapath and output catpath. 
+	# Optionally also pack every exposure into a SpecStore at catpath/specstore/;
+	# otherwise an existing store has the stars whose frames changed, or were 
+	# re-written after they were packed, repacked.
+	# Headers are scanned with `nthreads` threads, keeping only header_keys.
+	# A manifest of scanned frames is kept at catpath/manifest.fits; with 
+	# incremental = True only new or modified frames are rescanned and merged 
+	# into the existing filecat. Returns the cids whose frames changed (every 
+	# cid for a full rebuild), or None if filecat was not made. 
+
+	from astropy.table import Table
+
+	changed_cids = None
 
 	#### Make `filecat.fits`
 
@@ -295,25 +1273,33 @@ def make_catalogs(make_filecat = True, make_expcat = True, make_starcat = True,
 
 		print('making %sfilecat.fits' % catpath)
 
-		fits_files = glob.glob(datapath + '/*/*.fits')
-		filecat_rows = []; 
+		fits_files = sorted(glob.glob(datapath + '/*/*.fits'))
 
-		for nn,file in enumerate(tqdm(fits_files)):
-			
-			with fits.open(file) as f:
-			
-				row = dict(f[0].header)
-				row['filepath'] = file
-				row['cid'] = int(file.split('-')[-3])
-				row['camera'] = file.split('-')[-2]
-				row['expid'] = int(file.split('-')[-1].split('.')[0])
-				
-			filecat_rows.append(row)
-			
+		if incremental and not (os.path.exists(catpath + 'filecat.fits') and 
+								os.path.exists(catpath + 'manifest.fits')):
+			print('no existing filecat and manifest, rebuilding from scratch')
+			incremental = False
+
+		if incremental:
+
+			filecat = Table.read(catpath + 'filecat.fits')
+			filecat.convert_bytestring_to_unicode()
+			manifest = Table.read(catpath + 'manifest.fits')
+
+			filecat, manifest, changed_cids = _update_filecat(fits_files, filecat, manifest, 
+															  header_keys, nthreads)
+
+			print('%i stars have new or changed frames' % len(changed_cids))
+
+		else:
+
+			filecat, hashes = _scan_filecat(fits_files, header_keys, nthreads)
+			manifest = _make_manifest(fits_files, hashes)
+			changed_cids = np.unique(filecat['cid'])
 
-		filecat = Table(filecat_rows)
 		print('filecat has %i rows' % len(filecat))
 		filecat.write(catpath + 'filecat.fits', overwrite = True)
+		manifest.write(catpath + 'manifest.fits', overwrite = True)
 
 	#### Make `expcat.fits`
 
@@ -321,40 +1307,37 @@ def make_catalogs(make_filecat = True, make_expcat = True, make_starcat = True,
 
 		filecat = Table.read(catpath + 'filecat.fits')
 
-		mjds = np.unique(filecat['MJD'])
+		print('making %sexpcat.fits' % catpath)
 
-		expcat_rows = [];
+		# one row per (MJD, cid, expid), taken from the first frame of each group
 
-		for mjd in tqdm(mjds):
+		order, starts, groups = _group(filecat['expid'], filecat['cid'], filecat['MJD'])
+		filepath = np.asarray(filecat['filepath'])[order]
 
-		    mjdtable = filecat[filecat['MJD'] == mjd]
-		    
-		    cids = np.unique(mjdtable['cid'])
-		    
-		    for cid in cids:
-		        
-		        cidtable = mjdtable[mjdtable['cid'] == cid]
+		# pair red and blue frames by joining each camera's frames onto the groups
 
-		        expids = np.unique(cidtable['expid'])
+		files = {}
+		complete = np.ones(len(starts), dtype = bool)
 
-		        for expid in (expids):
+		for cam in ['r1', 'b1']:
+			sel = np.flatnonzero(filecat['camera'][order] == cam)
+			cam_groups, first = np.unique(groups[sel], return_index = True)
+			files[cam] = np.zeros(len(starts), dtype = filepath.dtype)
+			files[cam][cam_groups] = filepath[sel[first]]
+			found = np.zeros(len(starts), dtype = bool)
+			found[cam_groups] = True
+			complete &= found
 
-		            seltab = cidtable[cidtable['expid'] == expid]
-		            row = dict(seltab[0])
-		            row.pop('camera')
-		            row.pop('filepath')
+		if not np.all(complete):
+			print('dropping %i exposures without both r1 and b1 frames' % np.sum(~complete))
 
-		            redfile = seltab[seltab['camera'] == 'r1']['filepath'][0]
-		            bluefile = seltab[seltab['camera'] == 'b1']['filepath'][0]
+		expcat = filecat[order[starts[complete]]]
+		expcat.remove_columns(['camera', 'filepath'])
 
-		            row['rfile'] = redfile
-		            row['bfile'] = bluefile
+		expcat['rfile'] = files['r1'][complete]
+		expcat['bfile'] = files['b1'][complete]
+		expcat['dr2_id'] = np.asarray(expcat['G_DR2']).astype(int)
 
-		            row['dr2_id'] = int(seltab['G_DR2'][0])
-
-		            expcat_rows.append(row)
-
-		expcat = Table(expcat_rows)
 		print('expcat has %i rows' % len(expcat))
 		expcat.write(catpath + 'expcat.fits', overwrite = True)
 
@@ -366,21 +1349,44 @@ def make_catalogs(make_filecat = True, make_expcat = True, make_starcat = True,
 
 		print('making %sstarcat.fits' % catpath)
 
-		cids = np.unique(expcat['cid'])
-		starcat_rows = [];
+		order, starts, _ = _group(expcat['cid'])
+		nexp = np.diff(np.append(starts, len(order)))
 
-		for cid in tqdm(cids):
-			seltab = expcat[expcat['cid'] == cid]
-			
-			row = {}
-			row['cid'] = cid
-			row['nexp'] = len(seltab)
-			row['dr2_id'] = seltab['dr2_id'][0]
-			row['spec_ra'] = np.round(np.median(seltab['RA']), 5)
-			row['spec_dec'] = np.round(np.median(seltab['DEC']), 5)
-			
-			starcat_rows.append(row)
+		starcat = Table()
+		starcat['cid'] = np.asarray(expcat['cid'])[order[starts]]
+		starcat['nexp'] = nexp
+		starcat['dr2_id'] = np.asarray(expcat['dr2_id'])[order[starts]]
+		starcat['spec_ra'] = np.round(_group_median(expcat['RA'], expcat['cid'], starts, nexp), 5)
+		starcat['spec_dec'] = np.round(_group_median(expcat['DEC'], expcat['cid'], starts, nexp), 5)
 
-		starcat = Table(starcat_rows)
 		print('starcat has %i rows' % len(starcat))
 		starcat.write(catpath + 'starcat.fits', overwrite = True)
+
+	#### Make `specstore/`
+
+	if make_specstore:
+
+		expcat = Table.read(catpath + 'expcat.fits')
+
+		print('making %sspecstore/' % catpath)
+
+		store = SpecStore.build(catpath + 'specstore/', expcat)
+		print('specstore has %i exposures' % len(store.index))
+
+	elif (make_filecat or make_expcat) and os.path.exists(catpath + 'specstore/index.npy'):
+
+		# an existing store must not keep serving old frames: repack stars 
+		# whose frames changed, or were re-written since they were packed
+
+		expcat = Table.read(catpath + 'expcat.fits')
+		store = SpecStore(catpath + 'specstore/')
+
+		cids = store.stale(expcat)
+		if changed_cids is not None:
+			cids = np.union1d(cids, changed_cids)
+
+		if len(cids) > 0:
+			print('repacking %i stars in %sspecstore/' % (len(cids), catpath))
+			store.update(expcat, cids)
+
+	return changed_cids
@@ -3,23 +3,94 @@
 
 from __future__ import print_function, division, absolute_import
 
+import hashlib
+import os
+import threading
+
 import numpy as np
 
+# Directory for on-disk copies of resampling operators. If None, operators
+# are only cached in memory.
+cache_dir = None
+
+# Maximum number of operators kept in memory.
+max_cached = 64
+
+# Maximum number of transient operators (get_operator with persist=False)
+# kept in memory. They have their own cache, so they never evict the
+# persistent ones.
+max_transient = 64
+
+_operators = {}
+_transient_operators = {}
+
+# Guards the operator caches and the on-disk cache, so that prefetch threads do not
+# build, write or evict the same operator at once.
+_lock = threading.RLock()
+
 
 def make_bins(wavs):
     """ Given a series of wavelength points, find the edges and widths
-    of corresponding wavelength bins. """
-    edges = np.zeros(wavs.shape[0]+1)
-    widths = np.zeros(wavs.shape[0])
-    edges[0] = wavs[0] - (wavs[1] - wavs[0])/2
-    widths[-1] = (wavs[-1] - wavs[-2])
-    edges[-1] = wavs[-1] + (wavs[-1] - wavs[-2])/2
-    edges[1:-1] = (wavs[1:] + wavs[:-1])/2
-    widths[:-1] = edges[1:-1] - edges[:-2]
+    of corresponding wavelength bins. Leading dimensions of wavs are
+    treated as independent wavelength grids. """
+    edges = np.zeros(wavs.shape[:-1] + (wavs.shape[-1]+1,))
+    widths = np.zeros(wavs.shape)
+    edges[..., 0] = wavs[..., 0] - (wavs[..., 1] - wavs[..., 0])/2
+    widths[..., -1] = (wavs[..., -1] - wavs[..., -2])
+    edges[..., -1] = wavs[..., -1] + (wavs[..., -1] - wavs[..., -2])/2
+    edges[..., 1:-1] = (wavs[..., 1:] + wavs[..., :-1])/2
+    widths[..., :-1] = edges[..., 1:-1] - edges[..., :-2]
 
     return edges, widths
 
 
+def overlap_weights(new_wavs, old_wavs):
+    """ For every new bin, find the old bins it overlaps and the width
+    of each overlap, all at once with searchsorted.
+
+    Returns idx and weights, both of shape (len(new_wavs), nk), where nk
+    is the largest number of old bins covered by a new bin, and a boolean
+    array flagging new bins that extend outside old_wavs. Row j of the
+    resampled spectrum is sum(weights[j] * fluxes[idx[j]]) / sum(weights[j]).
+    Padding entries (and rows outside old_wavs) have zero weight. """
+
+    old_edges, old_widths = make_bins(old_wavs)
+    new_edges, new_widths = make_bins(new_wavs)
+    nold = old_wavs.shape[0]
+
+    outside = ((new_edges[:-1] < old_edges[0])
+               | (new_edges[1:] > old_edges[-1]))
+
+    # First and last old bins which are partially covered by each new bin
+    start = np.searchsorted(old_edges[1:], new_edges[:-1], side='right')
+    stop = np.searchsorted(old_edges[1:], new_edges[1:], side='left')
+    start = np.minimum(start, nold - 1)
+    stop = np.clip(stop, start, nold - 1)
+
+    span = (stop - start)[~outside]
+    nk = span.max() + 1 if len(span) > 0 else 1
+
+    idx = start[:, None] + np.arange(nk)
+    valid = (idx <= stop[:, None]) & ~outside[:, None]
+    idx = np.minimum(idx, nold - 1)
+    weights = np.where(valid, old_widths[idx], 0.)
+
+    # Scale the first and last old bin widths by the covered fraction
+    rows = np.nonzero(~outside & (stop > start))[0]
+    start_factor = ((old_edges[start[rows]+1] - new_edges[rows])
+                    / (old_edges[start[rows]+1] - old_edges[start[rows]]))
+    end_factor = ((new_edges[rows+1] - old_edges[stop[rows]])
+                  / (old_edges[stop[rows]+1] - old_edges[stop[rows]]))
+    weights[rows, 0] *= start_factor
+    weights[rows, stop[rows] - start[rows]] *= end_factor
+
+    # If new bin is fully inside an old bin, it takes that bin's value
+    single = ~outside & (stop == start)
+    weights[single, 0] = 1.
+
+    return idx, weights, outside
+
+
 def spectres(new_wavs, spec_wavs, spec_fluxes, spec_errs=None, fill=None,
              verbose=True):
 
@@ -27,6 +98,10 @@ def spectres(new_wavs, spec_wavs, spec_fluxes, spec_errs=None, fill=None,
     Function for resampling spectra (and optionally associated
     uncertainties) onto a new wavelength basis.
 
+    All new bins are computed at once: the overlap of every new bin with
+    the old bins is found with searchsorted (see overlap_weights), and
+    fluxes and errors are combined with array operations.
+
     Parameters
     ----------
 
@@ -36,7 +111,9 @@ def spectres(new_wavs, spec_wavs, spec_fluxes, spec_errs=None, fill=None,
 
     spec_wavs : numpy.ndarray
         1D array containing the current wavelength sampling of the
-        spectrum or spectra.
+        spectrum or spectra. May also be 2D with the same shape as a 2D
+        spec_fluxes, to resample a batch of spectra (e.g. exposures)
+        that each have their own wavelength sampling in one call.
 
     spec_fluxes : numpy.ndarray
         Array containing spectral fluxes at the wavelengths specified in
@@ -74,86 +151,189 @@ def spectres(new_wavs, spec_wavs, spec_fluxes, spec_errs=None, fill=None,
     old_fluxes = spec_fluxes
     old_errs = spec_errs
 
-    # Make arrays of edge positions and widths for the old and new bins
+    if old_errs is not None and old_errs.shape != old_fluxes.shape:
+        raise ValueError("If specified, spec_errs must be the same shape "
+                         "as spec_fluxes.")
 
-    old_edges, old_widths = make_bins(old_wavs)
-    new_edges, new_widths = make_bins(new_wavs)
+    if old_wavs.ndim == 1:
+        idx, weights, outside = overlap_weights(new_wavs, old_wavs)
+        gather = lambda arr: arr[..., idx]
+
+    else:
+        if old_wavs.shape != old_fluxes.shape:
+            raise ValueError("A batch of spec_wavs must have the same shape "
+                             "as spec_fluxes.")
 
-    # Generate output arrays to be populated
-    new_fluxes = np.zeros(old_fluxes[..., 0].shape + new_wavs.shape)
+        rows = [overlap_weights(new_wavs, wavs) for wavs in old_wavs]
+        nk = max(row[0].shape[1] for row in rows)
+        pad = lambda arr: np.pad(arr, ((0, 0), (0, nk - arr.shape[1])),
+                                 mode='edge')
+        idx = np.stack([pad(row[0]) for row in rows])
+        weights = np.stack([np.pad(row[1], ((0, 0), (0, nk - row[1].shape[1])))
+                            for row in rows])
+        outside = np.stack([row[2] for row in rows])
+        gather = lambda arr: np.take_along_axis(
+            arr, idx.reshape(len(arr), -1), axis=-1).reshape(idx.shape)
+
+    valid = weights > 0
+    norm = np.sum(weights, axis=-1)
+
+    if fill is None:
+        fill = np.nan
+
+    if verbose and (np.any(outside[..., 0]) or np.any(outside[..., -1])):
+        print("\nSpectres: new_wavs contains values outside the range "
+              "in spec_wavs, new_fluxes and new_errs will be filled "
+              "with the value set in the 'fill' keyword argument. \n")
+
+    # Padding entries may gather non-finite values, so mask rather than
+    # relying on their zero weight
+    with np.errstate(invalid='ignore', divide='ignore'):
+        f_widths = np.where(valid, gather(old_fluxes) * weights, 0.)
+        new_fluxes = np.sum(f_widths, axis=-1) / norm
+        new_fluxes[..., outside] = fill
+
+        if old_errs is not None:
+            e_wid = np.where(valid, gather(old_errs) * weights, 0.)
+            new_errs = np.sqrt(np.sum(e_wid**2, axis=-1)) / norm
+            new_errs[..., outside] = fill
 
+    # If errors were supplied return both new_fluxes and new_errs.
     if old_errs is not None:
-        if old_errs.shape != old_fluxes.shape:
-            raise ValueError("If specified, spec_errs must be the same shape "
-                             "as spec_fluxes.")
-        else:
-            new_errs = np.copy(new_fluxes)
+        return new_fluxes, new_errs
 
-    start = 0
-    stop = 0
-    warned = False
+    # Otherwise just return the new_fluxes spectrum array
+    else:
+        return new_fluxes
 
-    # Calculate new flux and uncertainty values, looping over new bins
-    for j in range(new_wavs.shape[0]):
 
-        # Add filler values if new_wavs extends outside of spec_wavs
-        if (new_edges[j] < old_edges[0]) or (new_edges[j+1] > old_edges[-1]):
-            new_fluxes[..., j] = fill
+class ResamplingOperator(object):
+    """ Flux-conserving resampling from one wavelength grid onto another
+    as a sparse (len(new_wavs), len(old_wavs)) matrix, so that the bin
+    overlap geometry is computed once and reused for every spectrum on
+    the same grid. Applying it gives the same result as spectres. """
 
-            if spec_errs is not None:
-                new_errs[..., j] = fill
+    def __init__(self, new_wavs, old_wavs):
+        import scipy.sparse
 
-            if (j == 0 or j == new_wavs.shape[0]-1) and verbose and not warned:
-                warned = True
-                print("\nSpectres: new_wavs contains values outside the range "
-                      "in spec_wavs, new_fluxes and new_errs will be filled "
-                      "with the value set in the 'fill' keyword argument. \n")
-            continue
+        idx, weights, outside = overlap_weights(new_wavs, old_wavs)
+        norm = np.sum(weights, axis=-1)
+        norm[outside] = 1.
 
-        # Find first old bin which is partially covered by the new bin
-        while old_edges[start+1] <= new_edges[j]:
-            start += 1
+        valid = weights > 0
+        rows = np.broadcast_to(np.arange(len(new_wavs))[:, None], idx.shape)
+        matrix = scipy.sparse.csr_matrix(
+            ((weights / norm[:, None])[valid], (rows[valid], idx[valid])),
+            shape=(len(new_wavs), len(old_wavs)))
 
-        # Find last old bin which is partially covered by the new bin
-        while old_edges[stop+1] < new_edges[j+1]:
-            stop += 1
+        self._set(matrix, outside)
 
-        # If new bin is fully inside an old bin start and stop are equal
-        if stop == start:
-            new_fluxes[..., j] = old_fluxes[..., start]
-            if old_errs is not None:
-                new_errs[..., j] = old_errs[..., start]
+    def _set(self, matrix, outside):
+        self.matrix = matrix
+        self.matrix_sq = matrix.multiply(matrix).tocsr()
+        self.outside = outside
 
-        # Otherwise multiply the first and last old bin widths by P_ij
-        else:
-            start_factor = ((old_edges[start+1] - new_edges[j])
-                            / (old_edges[start+1] - old_edges[start]))
+    @classmethod
+    def load(cls, path):
+        """ Load an operator saved with save(). """
+        import scipy.sparse
 
-            end_factor = ((new_edges[j+1] - old_edges[stop])
-                          / (old_edges[stop+1] - old_edges[stop]))
+        with np.load(path) as f:
+            matrix = scipy.sparse.csr_matrix(
+                (f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            outside = f['outside']
 
-            old_widths[start] *= start_factor
-            old_widths[stop] *= end_factor
+        op = cls.__new__(cls)
+        op._set(matrix, outside)
+        return op
 
-            # Populate new_fluxes spectrum and uncertainty arrays
-            f_widths = old_widths[start:stop+1]*old_fluxes[..., start:stop+1]
-            new_fluxes[..., j] = np.sum(f_widths, axis=-1)
-            new_fluxes[..., j] /= np.sum(old_widths[start:stop+1])
+    def save(self, path):
+        """ Save the operator as an .npz file. """
+        tmp = path + '.%i.%i.tmp' % (os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            np.savez(f, data=self.matrix.data, indices=self.matrix.indices,
+                     indptr=self.matrix.indptr, shape=self.matrix.shape,
+                     outside=self.outside)
+        os.replace(tmp, path)
 
-            if old_errs is not None:
-                e_wid = old_widths[start:stop+1]*old_errs[..., start:stop+1]
+    def apply(self, fluxes, errs=None, fill=None):
+        """ Resample fluxes (and optionally errs) of shape (..., nold).
+        Leading dimensions are resampled together with one sparse
+        matrix product. Returns arrays of shape (..., nnew). """
 
-                new_errs[..., j] = np.sqrt(np.sum(e_wid**2, axis=-1))
-                new_errs[..., j] /= np.sum(old_widths[start:stop+1])
+        if fill is None:
+            fill = np.nan
 
-            # Put back the old bin widths to their initial values
-            old_widths[start] /= start_factor
-            old_widths[stop] /= end_factor
+        shape = fluxes.shape[:-1] + (self.matrix.shape[0],)
+
+        new_fluxes = self.matrix.dot(fluxes.reshape(-1, fluxes.shape[-1]).T)
+        new_fluxes = new_fluxes.T.reshape(shape)
+        new_fluxes[..., self.outside] = fill
+
+        if errs is None:
+            return new_fluxes
+
+        with np.errstate(invalid='ignore'):
+            new_errs = self.matrix_sq.dot(
+                errs.reshape(-1, errs.shape[-1]).T**2)
+        new_errs = np.sqrt(new_errs.T.reshape(shape))
+        new_errs[..., self.outside] = fill
 
-    # If errors were supplied return both new_fluxes and new_errs.
-    if old_errs is not None:
         return new_fluxes, new_errs
 
-    # Otherwise just return the new_fluxes spectrum array
+
+def grid_fingerprint(*wavs):
+    """ Hash identifying a set of wavelength grids. """
+    h = hashlib.sha1()
+    for w in wavs:
+        w = np.ascontiguousarray(w, dtype=float)
+        h.update(str(w.shape).encode())
+        h.update(w.tobytes())
+    return h.hexdigest()
+
+
+def get_operator(new_wavs, old_wavs, cache_dir=None, persist=True):
+    """ Get the ResamplingOperator from old_wavs onto new_wavs, building
+    it only the first time a given pair of grids is seen. Operators are
+    cached in memory by grid fingerprint and, if cache_dir (or the module
+    level cache_dir) is set, on disk as well. Operators for one-off grids
+    should be requested with persist=False: they are never written to
+    disk and are kept in a separate, smaller memory cache. """
+
+    key = grid_fingerprint(new_wavs, old_wavs)
+
+    if cache_dir is None:
+        cache_dir = globals()['cache_dir']
+
+    if persist:
+        cache, maxsize = _operators, max_cached
     else:
-        return new_fluxes
+        cache, maxsize, cache_dir = _transient_operators, max_transient, None
+
+    with _lock:
+
+        if key in cache:
+            return cache[key]
+
+        path = None
+        op = None
+
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, 'resample_%s.npz' % key)
+            if os.path.exists(path):
+                try:
+                    op = ResamplingOperator.load(path)
+                except (OSError, ValueError, KeyError):
+                    op = None
+
+        if op is None:
+            op = ResamplingOperator(new_wavs, old_wavs)
+            if path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                op.save(path)
+
+        if len(cache) >= maxsize:
+            cache.pop(next(iter(cache)))
+        cache[key] = op
+
+    return op
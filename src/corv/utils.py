@@ -9,12 +9,12 @@ Created on Wed Aug 11 12:08:00 2021
 import numpy as np
 from bisect import bisect_left
 import scipy
-import matplotlib.pyplot as plt
-from astropy import constants as c
 
 def lineplot(wl, fl, ivar, corvmodel, params, gap = 0.3, printparams = True,
              figsize = (6, 5)):
     
+    import matplotlib.pyplot as plt
+    
     model = corvmodel.eval(params, x = wl)
     
     chi2 = 0
@@ -129,6 +129,50 @@ def cont_norm_lines(wl, fl, ivar, names, centres, windows, edges):
         
     return np.array(nwl), np.array(nfl), np.array(nivar)
 
+def cont_norm_lines_batch(wl, fls, names, centres, windows, edges):
+    """
+    Continuum-normalizes many spectra on a common wavelength grid at once. 
+    
+    Same as cont_norm_lines, but the linear continuum of every line is 
+    fitted for all rows of fls in a single least-squares call. 
+
+    Parameters
+    ----------
+    wl : array_like
+        wavelength.
+    fls : array_like
+        fluxes with shape (n_spectra, len(wl)).
+    names, centres, windows, edges : 
+        line definitions, as in cont_norm_lines.
+
+    Returns
+    -------
+    nwl : array_like
+        cropped wavelength array.
+    nfls : array_like
+        cropped and normalized fluxes with shape (n_spectra, len(nwl)).
+
+    """
+    fls = np.atleast_2d(fls)
+    nwl = [];
+    nfls = [];
+    
+    for line in names:
+        c1 = bisect_left(wl, centres[line] - windows[line])
+        c2 = bisect_left(wl, centres[line] + windows[line])
+        cwl, cfls = wl[c1:c2], fls[:, c1:c2]
+        
+        mask = np.ones(len(cwl))
+        mask[edges[line]:-edges[line]] = 0
+        mask = mask.astype(bool)
+        
+        p = np.polynomial.polynomial.polyfit(cwl[mask], cfls[:, mask].T, 1)
+        continuum = p[0][:, None] + p[1][:, None] * cwl
+        nwl.append(cwl)
+        nfls.append(cfls / continuum)
+        
+    return np.concatenate(nwl), np.concatenate(nfls, axis = 1)
+
 
 
 def crrej(wl, fl, ivar, nsig = 3, medwindow = 11, plot = False):
@@ -136,6 +180,7 @@ def crrej(wl, fl, ivar, nsig = 3, medwindow = 11, plot = False):
     medfl = scipy.ndimage.median_filter(fl, medwindow)
     
     if plot:
+        import matplotlib.pyplot as plt
         plt.plot(wl, fl)
         plt.plot(wl, medfl)
         plt.show()
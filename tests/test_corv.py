@@ -8,6 +8,7 @@ Created on Wed Aug 11 16:47:04 2021
 
 from matplotlib import pyplot as plt
 import numpy as np
+import pytest
 
 import corv
 
@@ -27,6 +28,27 @@ def test_travis():
 
 test_travis()
 
+def test_fitresult_pickle():
+    import pickle
+    import lmfit
+    
+    wl = np.linspace(6400, 6700, 1000)
+    corvmodel = corv.models.make_balmer_model(names = ['a'])
+    params = corvmodel.make_params()
+    params['RV'].set(value = 50)
+    fl = corvmodel.eval(params, x = wl)
+    
+    residual = lambda p: (fl - corvmodel.eval(p, x = wl))
+    res = lmfit.minimize(residual, corvmodel.make_params())
+    
+    compact = corv.fit.FitResult.from_lmfit(res, rv = 50, e_rv = 1)
+    compact = pickle.loads(pickle.dumps(compact))
+    
+    assert 'a0_center' not in compact.names
+    assert np.isclose(compact.value('RV'), res.params['RV'].value)
+    assert compact.to_params(corvmodel)['RV'].value == compact.value('RV')
+    assert compact.rv == 50
+
 # wl = np.linspace(4000, 8000, 8000)
 # plt.figure(figsize = (7,7))
 # corvmodel = corv.models.make_koester_model(names = ['a'])
@@ -37,4 +59,613 @@ test_travis()
 # params['teff'].set(value = 25500)
 # nwl, nfl = corv.models.get_normalized_model(wl, corvmodel, params)
 # plt.plot(nwl, nfl, 'r.')
-# plt.title('Koester DA')
\ No newline at end of file
+# plt.title('Koester DA')
+def test_spectres_batch():
+    rng = np.random.default_rng(0)
+    new_wavs = np.linspace(4000, 5000, 300)
+    old_wavs = np.sort(rng.uniform(3950, 5050, (3, 1000)), axis = 1)
+    fluxes = rng.normal(size = old_wavs.shape)
+    errs = np.abs(fluxes) + 1
+    
+    fl, err = corv.spectral_resampling.spectres(new_wavs, old_wavs, fluxes, errs)
+    
+    for ii in range(len(old_wavs)):
+        fl_i, err_i = corv.spectral_resampling.spectres(new_wavs, old_wavs[ii], 
+                                                        fluxes[ii], errs[ii])
+        assert np.allclose(fl[ii], fl_i)
+        assert np.allclose(err[ii], err_i)
+        
+    same = corv.spectral_resampling.spectres(old_wavs[0], old_wavs[0], fluxes[0])
+    assert np.allclose(same, fluxes[0])
+
+def test_resampling_operator(tmp_path):
+    rng = np.random.default_rng(1)
+    new_wavs = np.linspace(4000, 5000, 300)
+    old_wavs = np.sort(rng.uniform(3950, 5050, 1000))
+    fluxes = rng.normal(size = (4, 1000))
+    errs = np.abs(fluxes) + 1
+    
+    fl, err = corv.spectral_resampling.spectres(new_wavs, old_wavs, fluxes, errs)
+    
+    op = corv.spectral_resampling.get_operator(new_wavs, old_wavs, 
+                                               cache_dir = str(tmp_path))
+    assert op is corv.spectral_resampling.get_operator(new_wavs, old_wavs)
+    
+    corv.spectral_resampling._operators.clear()
+    op = corv.spectral_resampling.get_operator(new_wavs, old_wavs, 
+                                               cache_dir = str(tmp_path))
+    fl_op, err_op = op.apply(fluxes, errs)
+    
+    assert np.allclose(fl, fl_op)
+    assert np.allclose(err, err_op)
+    
+    from concurrent.futures import ThreadPoolExecutor
+    corv.spectral_resampling._operators.clear()
+    grids = [old_wavs + ii for ii in range(3)] * 8
+    get = lambda wavs: corv.spectral_resampling.get_operator(new_wavs, wavs, 
+                                                             cache_dir = str(tmp_path / 'mt'))
+    with ThreadPoolExecutor(4) as pool:
+        ops = list(pool.map(get, grids))
+    assert all(op is ops[ii % 3] for ii, op in enumerate(ops))
+    assert len(list((tmp_path / 'mt').glob('*.npz'))) == 3
+    assert not list((tmp_path / 'mt').glob('*.tmp'))
+
+def test_read_header(tmp_path):
+    from astropy.io import fits
+    
+    header = fits.Header()
+    header['MJD'] = 59000
+    header['RA'] = 10.5
+    header['SDSSNAME'] = "J0000+0000"
+    for ii in range(60):
+        header['KEY%i' % ii] = ii
+    path = str(tmp_path / 'spFrame-1000-b1-500.fits')
+    fits.PrimaryHDU(np.zeros(10), header = header).writeto(path)
+    
+    keys = ('MJD', 'RA', 'SDSSNAME', 'KEY59', 'MISSING')
+    assert corv.sdss.read_header(path, keys) == {'MJD': 59000, 'RA': 10.5, 
+                                                 'SDSSNAME': 'J0000+0000', 
+                                                 'KEY59': 59}
+    full = dict(fits.getheader(path))
+    assert corv.sdss.read_header(path, None) == full
+    assert list(corv.sdss.scan_headers([path] * 5, None, nthreads = 2)) == [full] * 5
+
+def test_prefetch():
+    out = list(corv.sdss.prefetch(lambda x: x * x, range(20), nahead = 3, nthreads = 2))
+    assert out == [(x, x * x) for x in range(20)]
+    
+    import time
+    calls = []
+    slow = lambda x: (calls.append(x), time.sleep(0.01))
+    gen = corv.sdss.prefetch(slow, range(100), nahead = 3, nthreads = 1)
+    next(gen)
+    gen.close()
+    assert len(calls) < 6
+
+def test_fits_table_writer(tmp_path):
+    from astropy.io import fits
+    
+    schema = [('cid', int), ('name', 'U8'), ('flag', bool), ('rv', float), ('small', 'u2')]
+    path = str(tmp_path / 'rows.fits')
+    
+    with corv.batch.FitsTableWriter(path, schema) as writer:
+        writer.write([dict(cid = 1, name = 'a', flag = True, rv = None, small = 60000)])
+        writer.write_columns(dict(cid = np.arange(2, 4), rv = np.ones(2)))
+        writer.write([dict(cid = np.ma.masked, name = np.ma.masked, rv = np.ma.masked)])
+    
+    table = fits.getdata(path)
+    assert list(table['cid']) == [1, 2, 3, 99]
+    assert list(table['name']) == ['a', '', '', '']
+    assert list(table['flag']) == [True, False, False, False]
+    assert np.isnan(table['rv'][0]) and table['rv'][2] == 1 and np.isnan(table['rv'][3])
+    assert table['small'][0] == 60000
+    
+    with pytest.raises(ValueError):
+        corv.batch.FitsTableWriter.check_schema([('big', 'u8')])
+
+def write_frames(datapath, cid, expids, mjd = 59000, seed = 0, npix = 2200, flux = None):
+    # Write synthetic b1/r1 spFrames for one star, returning their paths. 
+    # flux(wl) gives the noiseless spectrum (default flat)
+    from astropy.io import fits
+    import os
+    
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(datapath, str(cid)), exist_ok = True)
+    paths = []
+    for expid in expids:
+        for cam, (lo, hi) in [('b1', (3.55, 3.79)), ('r1', (3.75, 4.02))]:
+            header = fits.Header()
+            header['MJD'] = mjd
+            header['G_DR2'] = str(cid + 7000)
+            header['RA'] = 10.0 + 1e-4 * expid
+            header['DEC'] = -5.0
+            header['TAI-BEG'] = (mjd + 1e-3 * expid) * 86400
+            loglam = np.linspace(lo, hi, npix, dtype = np.float32)
+            fl = 1 if flux is None else flux(10**loglam.astype(float))
+            fl = fl * (1 + 0.05 * rng.normal(size = npix))
+            hdus = [fits.PrimaryHDU(fl.astype(np.float32), header = header),
+                    fits.ImageHDU(np.full(npix, 400, np.float32)),
+                    fits.ImageHDU(np.zeros(npix, np.int32)),
+                    fits.ImageHDU(loglam),
+                    fits.ImageHDU(np.ones(npix, np.float32)),
+                    fits.ImageHDU(np.zeros(npix, np.float32))]
+            path = os.path.join(datapath, str(cid), 'spFrame-%i-%s-%i.fits' % (cid, cam, expid))
+            fits.HDUList(hdus).writeto(path, overwrite = True)
+            paths.append(path)
+    return paths
+
+def test_coadd_cache(tmp_path):
+    import os
+    
+    datapath, catpath = str(tmp_path / 'data'), str(tmp_path / 'cat') + '/'
+    os.makedirs(catpath)
+    write_frames(datapath, 101, [1, 2, 3])
+    corv.sdss.make_catalogs(catpath = catpath, datapath = datapath, nthreads = 2)
+    context = corv.sdss.DataContext(datapath, catpath)
+    
+    made = []
+    make_coadd = corv.sdss.make_coadd
+    def counted(*args, **kw):
+        made.append(kw.get('method'))
+        return make_coadd(*args, **kw)
+    corv.sdss.make_coadd = counted
+    try:
+        wl, fl, ivar = corv.sdss.get_coadd(101, context = context)
+        corv.sdss.get_coadd(101, method = 'median', context = context)
+        wl, fl_cached, ivar_cached = corv.sdss.get_coadd(101, context = context)
+    finally:
+        corv.sdss.make_coadd = make_coadd
+    
+    assert made == ['ivar_mean', 'median']
+    assert np.allclose(fl, fl_cached, equal_nan = True)
+    assert len(os.listdir(catpath + 'coadds/')) == 2
+
+def test_shifted_resampling():
+    sdss, sr = corv.sdss, corv.spectral_resampling
+    rng = np.random.default_rng(2)
+    logwl = np.linspace(3.55, 3.79, 2200)
+    fl = 1 + 0.05 * rng.normal(size = 2200)
+    exps = dict(data = [dict(logwl = logwl, fl = fl, ivar = np.full(2200, 400.))])
+    
+    sr._operators.clear()
+    for rv in [0, 13.7, -250.2, 4000]:
+        shift = 0.5 * np.log10((1 - rv / sdss.c_kms) / (1 + rv / sdss.c_kms))
+        pixels = np.round(-shift / sdss.dloglam * sdss.shift_subpix) / sdss.shift_subpix
+        ref = sr.spectres(sdss.loglamgrid, logwl - pixels * sdss.dloglam, fl, fill = np.nan)
+        fls, sigmas = sdss._resample_exposures(exps, rvs = [rv])
+        assert np.allclose(fls[0], ref, equal_nan = True)
+    
+    # only the unshifted operator is kept in the persistent cache
+    assert len(sr._operators) == 1
+
+def balmer_exposures(rvs, snr = None, seed = 6):
+    # Balmer-model exposures at the given RVs, on an SDSS-like log grid. 
+    # Noiseless (but with finite ivar) if snr is None
+    corvmodel = corv.models.make_balmer_model()
+    params = corvmodel.make_params()
+    logwl = np.linspace(3.56, 3.95, 4000)
+    rng = np.random.default_rng(seed)
+    data = []
+    for rv in rvs:
+        params['RV'].set(value = rv)
+        model = corvmodel.eval(params, x = 10**logwl)
+        noise = 0 if snr is None else rng.normal(size = logwl.size) / snr
+        data.append(dict(logwl = logwl, fl = model * (1 + noise), ivar = (snr or 1e4)**2 / model**2))
+    return dict(data = data), corvmodel
+
+def test_shift_sign():
+    # shifting by each exposure's own RV lands the lines at rest wavelength
+    rvs = np.array([-80., 10., 65.])
+    exps = balmer_exposures(rvs)[0]
+    wl, fl_rest, ivar_rest = corv.sdss.make_coadd(balmer_exposures([0.])[0])
+    sel = (wl > 3800) & (wl < 8000)
+    
+    mismatch = lambda rvs: np.max(np.abs(corv.sdss.make_coadd(exps, rvs = rvs)[1] / fl_rest - 1)[sel])
+    assert mismatch(rvs) < 3e-4
+    assert mismatch(-rvs) > 5 * mismatch(rvs) and mismatch(None) > 3 * mismatch(rvs)
+
+def test_shift_and_add():
+    rvs = np.array([-80., 10., 65.])
+    exps, corvmodel = balmer_exposures(rvs, snr = 200)
+    wl, fl, ivar, rv_fit, e_rvs, param_res = corv.sdss.shift_and_add(
+        exps, corvmodel, niter = 2, fit_kw = dict(xcorr_kw = dict(min_rv = -300, max_rv = 300, 
+                                                                  npoints = 61)))
+    assert np.all(np.abs(rv_fit - rvs) < 3 * e_rvs) and np.all(e_rvs < 10)
+    
+    wl, fl_ref, ivar_ref = corv.sdss.make_coadd(exps, rvs = rv_fit)
+    assert np.allclose(fl, fl_ref, equal_nan = True)
+
+def test_specstore(tmp_path):
+    import os
+    
+    datapath, catpath = str(tmp_path / 'data'), str(tmp_path / 'cat') + '/'
+    os.makedirs(catpath)
+    write_frames(datapath, 101, [1, 2])
+    corv.sdss.make_catalogs(catpath = catpath, datapath = datapath, nthreads = 2, 
+                            make_specstore = True)
+    
+    context = corv.sdss.DataContext(datapath, catpath)
+    assert isinstance(context.store, corv.sdss.SpecStore)
+    assert corv.sdss.DataContext(datapath, catpath, store = False).store is None
+    
+    exps = corv.sdss.get_exposures(101, keys = ('logwl', 'fl', 'wdisp'), context = context)
+    fits_exps = corv.sdss.get_exposures(101, keys = ('logwl', 'fl', 'wdisp'), store = False,
+                                        context = context)
+    for exp, fits_exp in zip(exps['data'], fits_exps['data']):
+        assert isinstance(exp['fl'], np.memmap)
+        for key in ('logwl', 'fl', 'ivar', 'wdisp'):
+            assert np.array_equal(exp[key], fits_exp[key])
+    
+    # coadds served from the store are keyed on the store, not the frames
+    corv.sdss.get_coadd(101, context = context)
+    for file in os.listdir(os.path.join(datapath, '101')):
+        os.utime(os.path.join(datapath, '101', file), (0, 0))
+    wl, fl, ivar = corv.sdss.get_coadd(101, context = context)
+    assert len(os.listdir(catpath + 'coadds/')) == 1
+    
+    # re-reduced frames are repacked into the store by make_catalogs
+    from astropy.io import fits
+    for file in os.listdir(os.path.join(datapath, '101')):
+        with fits.open(os.path.join(datapath, '101', file), mode = 'update') as hdul:
+            hdul[0].data = 2 * hdul[0].data
+    corv.sdss.make_catalogs(catpath = catpath, datapath = datapath, nthreads = 2, 
+                            incremental = True)
+    context = corv.sdss.DataContext(datapath, catpath)
+    exps = corv.sdss.get_exposures(101, context = context)
+    assert np.allclose(exps['data'][0]['fl'], 2 * fits_exps['data'][0]['fl'])
+    wl, fl_new, ivar_new = corv.sdss.get_coadd(101, context = context)
+    assert np.allclose(fl_new, 2 * fl, equal_nan = True)
+
+def test_group_catalogs(tmp_path):
+    from astropy.table import Table
+    import os
+    
+    datapath, catpath = str(tmp_path / 'data'), str(tmp_path / 'cat') + '/'
+    os.makedirs(catpath)
+    write_frames(datapath, 102, [3], mjd = 59001, seed = 1)
+    write_frames(datapath, 102, [4], mjd = 59000, seed = 2)
+    write_frames(datapath, 101, [1, 2], mjd = 59000, seed = 3)
+    write_frames(datapath, 100, [5], mjd = 59001, seed = 4)
+    corv.sdss.make_catalogs(catpath = catpath, datapath = datapath, nthreads = 2)
+    
+    filecat = Table.read(catpath + 'filecat.fits')
+    expcat = Table.read(catpath + 'expcat.fits')
+    starcat = Table.read(catpath + 'starcat.fits')
+    
+    # reference expcat and starcat from one loop per MJD, cid and expid
+    rows = []
+    for mjd in np.unique(filecat['MJD']):
+        for cid in np.unique(filecat['cid'][filecat['MJD'] == mjd]):
+            for expid in np.unique(filecat['expid'][(filecat['MJD'] == mjd) & (filecat['cid'] == cid)]):
+                sel = filecat[(filecat['MJD'] == mjd) & (filecat['cid'] == cid) & (filecat['expid'] == expid)]
+                rows.append((cid, expid, mjd, sel[sel['camera'] == 'r1']['filepath'][0], 
+                             sel[sel['camera'] == 'b1']['filepath'][0], int(sel['G_DR2'][0])))
+    assert len(rows) == 5
+    assert [tuple(row) for row in expcat['cid', 'expid', 'MJD', 'rfile', 'bfile', 'dr2_id']] == rows
+    
+    rows = []
+    for cid in np.unique(expcat['cid']):
+        sel = expcat[expcat['cid'] == cid]
+        rows.append((cid, len(sel), sel['dr2_id'][0], np.round(np.median(sel['RA']), 5), 
+                     np.round(np.median(sel['DEC']), 5)))
+    assert [tuple(row) for row in starcat['cid', 'nexp', 'dr2_id', 'spec_ra', 'spec_dec']] == rows
+
+def test_incremental_catalogs(tmp_path):
+    from astropy.io import fits
+    from astropy.table import Table
+    import os
+    
+    datapath = str(tmp_path / 'data')
+    catpath, fullpath = str(tmp_path / 'cat') + '/', str(tmp_path / 'full') + '/'
+    os.makedirs(catpath)
+    os.makedirs(fullpath)
+    write_frames(datapath, 101, [1, 2])
+    modified = write_frames(datapath, 102, [3, 4])
+    removed = write_frames(datapath, 103, [5])
+    corv.sdss.make_catalogs(catpath = catpath, datapath = datapath, nthreads = 2)
+    
+    write_frames(datapath, 104, [6])
+    fits.setval(modified[0], 'RA', value = 11.0)
+    for path in removed:
+        os.remove(path)
+    for path in os.listdir(os.path.join(datapath, '101')):
+        os.utime(os.path.join(datapath, '101', path), (1e9, 1e9))
+    
+    changed = corv.sdss.make_catalogs(catpath = catpath, datapath = datapath, nthreads = 2, 
+                                      incremental = True)
+    assert list(changed) == [102, 103, 104]
+    
+    corv.sdss.make_catalogs(catpath = fullpath, datapath = datapath, nthreads = 2)
+    for name in ('filecat', 'expcat', 'starcat'):
+        incremental, full = Table.read(catpath + name + '.fits'), Table.read(fullpath + name + '.fits')
+        assert incremental.colnames == full.colnames
+        for col in full.colnames:
+            assert np.array_equal(incremental[col], full[col])
+
+def coadd_pixels(fls, sigmas, method):
+    # Reference co-add, one pixel at a time
+    fl, ivar = np.full(fls.shape[1], np.nan), np.zeros(fls.shape[1])
+    for px in range(fls.shape[1]):
+        good = np.isfinite(sigmas[:, px]) & (fls[:, px] > 0)
+        fl_px, sigma_px = fls[good, px], sigmas[good, px]
+        if len(fl_px) == 0:
+            continue
+        if method == 'ivar_mean':
+            fl[px] = np.average(fl_px, weights = 1 / sigma_px**2)
+            ivar[px] = np.sum(1 / sigma_px**2)
+        else:
+            fl[px] = np.median(fl_px) if method == 'median' else np.mean(fl_px)
+            ivar[px] = len(fl_px)**2 / np.sum(sigma_px**2)
+    return fl, ivar
+
+def test_combine():
+    rng = np.random.default_rng(3)
+    fls = 1 + 0.5 * rng.normal(size = (5, 400))
+    sigmas = rng.uniform(0.05, 0.2, size = (5, 400))
+    sigmas[rng.uniform(size = sigmas.shape) < 0.2] = np.nan
+    fls[:, :10] = -1
+    fls[2, 20:30] = np.nan
+    
+    for method in ('ivar_mean', 'mean', 'median'):
+        fl, ivar, ngood = corv.sdss._combine(fls, sigmas, method)
+        fl_ref, ivar_ref = coadd_pixels(fls, sigmas, method)
+        assert np.allclose(fl, fl_ref, equal_nan = True)
+        assert np.allclose(ivar, ivar_ref)
+        assert np.all(ivar[:10] == 0) and np.all(ngood[:10] == 0)
+
+def test_sigclip_coadd():
+    rng = np.random.default_rng(4)
+    logwl = np.linspace(3.60, 3.70, 1000)
+    exps = dict(data = [dict(logwl = logwl, fl = 1 + 0.01 * rng.normal(size = 1000), 
+                             ivar = np.full(1000, 1e4)) for ii in range(4)])
+    exps['data'][0]['fl'][500:510] = 50 # cosmic ray
+    
+    wl, fl, ivar, nexp = corv.sdss.make_coadd(exps, method = 'sigclip_ivar_mean', return_nexp = True)
+    wl, fl_all, ivar_all = corv.sdss.make_coadd(exps)
+    exps['data'] = exps['data'][1:]
+    wl, fl_clean, ivar_clean = corv.sdss.make_coadd(exps)
+    
+    hit = (wl > 10**logwl[500]) & (wl < 10**logwl[509])
+    clean = (ivar_all > 0) & ((wl < 10**logwl[498]) | (wl > 10**logwl[511]))
+    assert np.all(nexp[hit] == 3) and np.all(nexp[clean] == 4) and np.all(nexp[ivar_all == 0] == 0)
+    assert np.allclose(fl[hit], fl_clean[hit]) and np.allclose(ivar[hit], ivar_clean[hit])
+    assert np.allclose(fl[clean], fl_all[clean])
+    assert np.all(fl_all[hit] > 5)
+
+def test_coadder(tmp_path):
+    rng = np.random.default_rng(5)
+    exps = dict(data = [dict(logwl = np.linspace(3.60 + 0.01 * ii, 3.70, 1000), 
+                             fl = 1 + 0.05 * rng.normal(size = 1000), 
+                             ivar = rng.uniform(100, 400, 1000)) for ii in range(4)])
+    rvs = [0, 20, -35.5, 0]
+    
+    coadder = corv.sdss.Coadder(keep_exposures = True)
+    coadder.add(exps['data'][0], rv = rvs[0])
+    coadder.save(str(tmp_path / 'coadder.npz'))
+    coadder = corv.sdss.Coadder.load(str(tmp_path / 'coadder.npz'))
+    coadder.add_exposures(dict(data = exps['data'][1:]), rvs = rvs[1:])
+    
+    for method in ('ivar_mean', 'mean', 'median', 'sigclip_ivar_mean'):
+        wl, fl, ivar, nexp = coadder.coadd(method = method, return_nexp = True)
+        wl, fl_ref, ivar_ref, nexp_ref = corv.sdss.make_coadd(exps, method = method, rvs = rvs, 
+                                                              return_nexp = True)
+        assert np.allclose(fl, fl_ref, equal_nan = True)
+        assert np.allclose(ivar, ivar_ref)
+        assert np.array_equal(nexp, nexp_ref)
+
+def test_group_coadds():
+    rng = np.random.default_rng(6)
+    exps = dict(data = [dict(logwl = np.linspace(3.60 + 0.01 * ii, 3.70, 1000), 
+                             fl = 1 + 0.05 * rng.normal(size = 1000), 
+                             ivar = rng.uniform(100, 400, 1000)) for ii in range(5)])
+    # two nights, given out of order
+    exps['header'] = {'TAI-BEG': 86400 * np.array([59001.1, 59000.1, 59001.2, 59000.3, 59001.3])}
+    rvs = np.array([0, 20, -35.5, 0, 12])
+    
+    for method in ('ivar_mean', 'median', 'sigclip_ivar_mean'):
+        wl, fl, ivar, groups, nexp = corv.sdss.make_group_coadds(exps, method = method, rvs = rvs, 
+                                                                 return_nexp = True)
+        assert list(groups) == [0, 1] and fl.shape == (2, corv.sdss.nwl)
+        for gg, idx in enumerate([[1, 3], [0, 2, 4]]):
+            sub = dict(data = [exps['data'][ii] for ii in idx])
+            wl, fl_ref, ivar_ref, nexp_ref = corv.sdss.make_coadd(sub, method = method, rvs = rvs[idx],
+                                                                  return_nexp = True)
+            assert np.allclose(fl[gg], fl_ref, equal_nan = True)
+            assert np.allclose(ivar[gg], ivar_ref)
+            assert np.array_equal(nexp[gg], nexp_ref)
+    
+    # explicit labels override the TAI-BEG gaps
+    wl, fl, ivar, groups = corv.sdss.make_group_coadds(exps, labels = ['a', 'b', 'a', 'b', 'b'])
+    wl, fl_ref, ivar_ref = corv.sdss.make_coadd(dict(data = [exps['data'][ii] for ii in (0, 2)]))
+    assert list(groups) == ['a', 'b'] and np.allclose(fl[0], fl_ref, equal_nan = True)
+
+def fake_wd_interp():
+    # Small synthetic stand-in for the Koester DA grid: Balmer lines whose 
+    # widths grow with logg and teff, on a power-law continuum
+    from scipy.interpolate import RegularGridInterpolator
+    
+    logg, logteff = np.linspace(4.5, 9.5, 11), np.log10(np.linspace(3000, 40000, 20))
+    logwl = np.log10(np.linspace(3550, 9100, 3000))
+    g, t, x = np.meshgrid(logg, logteff, logwl, indexing = 'ij')
+    wl = 10**x
+    width = 8 + 3 * (g - 6.5) + 10**t / 4000
+    lines = sum(0.6 * np.exp(-0.5 * ((wl - centre) / width)**2) 
+                for centre in (6564.61, 4862.68, 4341.68, 4102.89, 3971.20, 3890.12))
+    flux = (wl / 5000)**-2 * (10**t / 1e4) * (1 - lines)
+    return RegularGridInterpolator((logg, logteff, logwl), np.log10(flux))
+
+def test_batch_run(tmp_path, monkeypatch):
+    from astropy.io import fits
+    from astropy.table import Table
+    import os
+    
+    monkeypatch.setitem(vars(corv.models), 'wd_interp', fake_wd_interp())
+    flux = lambda wl: corv.models.get_koester(wl, 12000, 8, 50, 2)
+    
+    datapath, catpath = str(tmp_path / 'data'), str(tmp_path / 'cat') + '/'
+    outdir, operator_cache = str(tmp_path / 'out'), str(tmp_path / 'ops')
+    shard_dir = os.path.join(outdir, 'shards')
+    os.makedirs(catpath)
+    write_frames(datapath, 101, [1], seed = 1, flux = flux)
+    broken = write_frames(datapath, 103, [4], seed = 3, flux = flux)
+    corv.sdss.make_catalogs(catpath = catpath, datapath = datapath, nthreads = 2)
+    Table.read(catpath + 'starcat.fits')['cid', 'nexp'].write(catpath + 'dacat.fits')
+    os.remove(broken[1])
+    corv.spectral_resampling._operators.clear() # forked workers would inherit them
+    
+    run = lambda: corv.batch.run(catpath + 'dacat.fits', outdir, datapath = datapath, 
+                                 catpath = catpath, nproc = 2, chunk_size = 1, nahead = 2, 
+                                 operator_cache = operator_cache, start_method = 'fork')
+    
+    # the star with a missing frame is skipped, and its chunk still finishes
+    assert run() == 1
+    corvcat = fits.getdata(os.path.join(outdir, 'corvcat.fits'))
+    assert list(corvcat['cid']) == [101]
+    for col in ('coadd_rv_k', 'coadd_rv_b', 'rv_k', 'rv_b'):
+        assert abs(corvcat[col][0] - 50) < 25
+    assert 8000 < corvcat['coadd_teff'][0] < 16000
+    assert sorted(corv.batch.completed_shards(shard_dir)[1]) == [101, 103]
+    assert len(os.listdir(operator_cache)) > 0
+    assert all(name.endswith('.npz') for name in os.listdir(operator_cache))
+    
+    # as if killed before finishing 103: only that chunk is run again
+    index = [ii for ii in corv.batch.completed_shards(shard_dir)[0] 
+             if np.load(corv.batch._shard(shard_dir, ii, 'cids.npy'))[0] == 103][0]
+    os.remove(corv.batch._shard(shard_dir, index, 'cids.npy'))
+    finished = [corv.batch._shard(shard_dir, 1 - index, ext) for ext in ('fits', 'cids.npy')]
+    mtimes = [os.stat(path).st_mtime_ns for path in finished]
+    
+    assert run() == 1
+    assert [os.stat(path).st_mtime_ns for path in finished] == mtimes
+    assert sorted(corv.batch.completed_shards(shard_dir)[1]) == [101, 103]
+
+def balmer_spectrum(rv, snr = 100, seed = 0):
+    # Noisy Balmer-model spectrum at a known RV, and the model's parameters
+    wl = np.linspace(3600, 9000, 6000)
+    corvmodel = corv.models.make_balmer_model()
+    params = corvmodel.make_params()
+    params['RV'].set(value = rv)
+    model = corvmodel.eval(params, x = wl)
+    fl = model * (1 + np.random.default_rng(seed).normal(size = wl.size) / snr)
+    params['RV'].set(value = 0)
+    return wl, fl, snr**2 / model**2, corvmodel, params
+
+def test_xcorr_rv():
+    wl, fl, ivar, corvmodel, params = balmer_spectrum(123)
+    rv, e_rv, redchi, rvgrid, cc = corv.fit.xcorr_rv(wl, fl, ivar, corvmodel, params.copy(), 
+                                                     npoints = 301)
+    assert abs(rv - 123) < 3 * e_rv and e_rv < 20
+    
+    # the batched chi-square curve matches the per-RV loop over normalized_residual
+    loop = []
+    for value in rvgrid:
+        params['RV'].set(value = value)
+        resid = corv.fit.normalized_residual(wl, fl, ivar, corvmodel, params, fit_window = 25)
+        loop.append(np.nansum(resid**2))
+    assert np.allclose(cc, loop)
+
+def test_bootstrap_rv():
+    wl, fl, ivar, corvmodel, params = balmer_spectrum(123)
+    e_rv = corv.fit.xcorr_rv(wl, fl, ivar, corvmodel, params.copy(), npoints = 301)[1]
+    
+    for mode in ('ivar', 'residual'):
+        rv, e_lo, e_hi, rvs = corv.fit.bootstrap_rv(wl, fl, ivar, corvmodel, params.copy(), 
+                                                    nboot = 200, mode = mode, npoints = 301, 
+                                                    seed = 1)
+        assert len(rvs) == 200
+        assert abs(rv - 123) < 3 * e_rv
+        assert 0.5 * e_rv < e_lo < 2 * e_rv and 0.5 * e_rv < e_hi < 2 * e_rv
+    
+    with pytest.raises(ValueError):
+        corv.fit.bootstrap_rv(wl, fl, ivar, corvmodel, params, mode = 'jackknife')
+
+def test_fit_cache(tmp_path, monkeypatch):
+    wl, fl, ivar, corvmodel, params = balmer_spectrum(123)
+    cache = corv.fit.FitCache(str(tmp_path))
+    
+    # put merges into the existing entry instead of replacing it
+    cache.put(7, rv = 5.)
+    cache.put(7, corv.fit.FitResult(['teff'], [12000.], [100.]))
+    cache.put(7, e_rv = 2.)
+    entry = cache.get(7)
+    assert float(entry['rv']) == 5 and float(entry['e_rv']) == 2
+    assert list(entry['names']) == ['teff'] and entry['values'][0] == 12000
+    assert 8 not in cache and cache.get(8) is None
+    
+    # record the RV grid of every x-correlation
+    grids = []
+    xcorr_rv = corv.fit.xcorr_rv
+    def spy(*args, **kw):
+        grids.append((kw.get('min_rv', -1500), kw.get('max_rv', 1500)))
+        return xcorr_rv(*args, **kw)
+    monkeypatch.setattr(corv.fit, 'xcorr_rv', spy)
+    
+    # a cached RV far from the truth puts the minimum on the warm grid's edge,
+    # so fit_rv falls back to the full grid
+    cache.put(1, rv = -1000)
+    rv = corv.fit.fit_rv(wl, fl, ivar, corvmodel, params.copy(), xcorr_kw = dict(npoints = 301),
+                         cache = cache, key = 1)[0]
+    assert grids == [(-1300, -700), (-1500, 1500)]
+    assert abs(rv - 123) < 10 and float(cache.get(1)['rv']) == rv
+    
+    # a warm fit_corv starts from the cached parameters and RV
+    cold = corv.fit.fit_corv(wl, fl, ivar, corvmodel, xcorr_kw = dict(npoints = 301),
+                             cache = cache, key = 2)
+    del grids[:]
+    warm = corv.fit.fit_corv(wl, fl, ivar, corvmodel, xcorr_kw = dict(npoints = 301),
+                             cache = cache, key = 2)
+    assert warm[3].nfev < cold[3].nfev / 2
+    assert grids == [(cold[0] - 300, cold[0] + 300)]
+    assert abs(warm[0] - cold[0]) < 1
+    for name, value in cold[3].params.valuesdict().items():
+        assert np.isclose(warm[3].params[name].value, value, rtol = 1e-3, atol = 1e-6)
+
+def test_koester_batch(monkeypatch):
+    monkeypatch.setitem(vars(corv.models), 'wd_interp', fake_wd_interp())
+    wl = np.linspace(3700, 8800, 4000)
+    teff, logg = np.array([8000, 12000, 25000]), np.array([7.5, 8.0, 8.7])
+    rv, res = np.array([-300, 0, 450.5]), np.array([1, 1, 2])
+    
+    flux = corv.models.get_koester_batch(wl, teff, logg, rv, res)
+    for ii in range(3):
+        assert np.allclose(flux[ii], corv.models.get_koester(wl, teff[ii], logg[ii], rv[ii], res[ii]), 
+                           equal_nan = True)
+    
+    corvmodel = corv.models.make_koester_model()
+    params = corvmodel.make_params()
+    nwl, nfl = corv.models.get_normalized_model_batch(wl, corvmodel, params, RV = rv, teff = teff)
+    for ii in range(3):
+        params['RV'].set(value = rv[ii])
+        params['teff'].set(value = teff[ii])
+        nwl_i, nfl_i = corv.models.get_normalized_model(wl, corvmodel, params)
+        assert np.allclose(nwl, nwl_i) and np.allclose(nfl[ii], nfl_i, equal_nan = True)
+
+def test_sample_corv(monkeypatch):
+    pytest.importorskip('emcee')
+    monkeypatch.setitem(vars(corv.models), 'wd_interp', fake_wd_interp())
+    
+    wl = np.linspace(3700, 8800, 4000)
+    model = corv.models.get_koester(wl, 12000, 8, 40, 1)
+    fl = model * (1 + 0.02 * np.random.default_rng(6).normal(size = wl.size))
+    ivar = 1 / (0.02 * model)**2
+    
+    corvmodel = corv.models.make_koester_model()
+    chain, sampler = corv.fit.sample_corv(wl, fl, ivar, corvmodel, vary = ('RV',), nwalkers = 8, 
+                                          nsteps = 150, nburn = 50, seed = 1)
+    assert chain.shape == (800, 1)
+    assert abs(np.median(chain) - 40) < 3 * np.std(chain) < 30
+
+def test_fisher_rv_error():
+    # Gaussian absorption line with constant ivar, whose Fisher error is known
+    wl = np.linspace(4900, 5100, 2000)
+    depth, width, centre, ivar = 0.5, 5, 5000, np.full(2000, 1e4)
+    line = lambda rv: 1 - depth * np.exp(-0.5 * ((wl - centre * (1 + rv / corv.models.c_kms)) / width)**2)
+    
+    rvgrid = np.linspace(-1500, 1500, 501)
+    template = np.array([line(rv) for rv in rvgrid])
+    
+    for rv in (0, 37.3, -250.1):
+        mu = centre * (1 + rv / corv.models.c_kms)
+        dmdrv = (line(rv) - 1) * (wl - mu) / width**2 * centre / corv.models.c_kms
+        analytic = 1 / np.sqrt(np.sum(ivar * dmdrv**2))
+        assert np.isclose(corv.fit.fisher_rv_error(rvgrid, template, ivar, rv), analytic, rtol = 0.01)